@@ -1,2 +1,8 @@
-from .client import Redash
-from .date_ranges import get_frontend_vals
+from .client import ClientPool, Redash
+from .async_client import AsyncRedash
+from .cache import CacheMiss, DiskCache, ResponseCache, ResultCache
+from .date_ranges import DynamicDates, get_frontend_vals
+from .instrumentation import LatencyCollector, RequestEvent
+from .jobs import JobTracker, QueryExecutionError, QueryJob, QueryTimeoutError
+from .ratelimit import RateLimit
+from .retry import RetryPolicy
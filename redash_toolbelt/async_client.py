@@ -0,0 +1,185 @@
+import asyncio
+import functools
+import itertools
+import math
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import Redash
+from .jobs import Backoff
+
+# Rows read from a result stream per worker thread call
+STREAM_BATCH_SIZE = 1000
+
+
+class AsyncRedash(object):
+    """asyncio counterpart of `Redash`.
+
+    Every public method of `Redash` is available as a coroutine with the same
+    signature, e.g. `await client.get_query(1)`. Methods that return lazy
+    iterators, such as `scheduled_queries`, return lists instead, so that no
+    request is made outside the worker pool. `iter_pages`, `iter_items` and
+    `stream_query_result` are async generators, and `execute_query` waits for
+    the query to finish.
+
+    Requests share one `Redash` session, and therefore one connection pool,
+    and run on a worker pool of `concurrency` threads. A semaphore caps the
+    requests in flight, so callers can `asyncio.gather` thousands of calls
+    without opening a connection or a thread for each of them.
+
+    Extra keyword arguments, such as `retry`, are passed on to `Redash`.
+    """
+
+    def __init__(self, redash_url, api_key, concurrency=8, **kwargs):
+        self.client = Redash(redash_url, api_key, concurrency=concurrency, **kwargs)
+        self.redash_url = redash_url
+        self.concurrency = self.client.concurrency
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._semaphore = None
+
+    def __getattr__(self, name):
+        if name == "client" or name.startswith("__"):
+            raise AttributeError(name)
+
+        attr = getattr(self.client, name)
+
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self._run(_materialized, attr, *args, **kwargs)
+
+        return method
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.client.session.close()
+
+    async def _run(self, func, *args, **kwargs):
+        # Created lazily so that it binds to the loop that is actually running.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        loop = asyncio.get_event_loop()
+        async with self._semaphore:
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+
+    async def execute_query(self, query_id, parameters=None, max_age=0, timeout=None):
+        """Execute a query and return its `QueryJob` once the result is loaded.
+
+        The job is polled from the event loop with a `Backoff`, so waiting
+        does not hold a worker thread. Raises `QueryTimeoutError` or
+        `QueryExecutionError` like `QueryJob.wait`.
+        """
+
+        job = await self._run(
+            self.client.execute_query, query_id, parameters=parameters, max_age=max_age
+        )
+
+        if job.query_result is None:
+            backoff = Backoff()
+            loop = asyncio.get_event_loop()
+            deadline = None if timeout is None else loop.time() + timeout
+
+            while not await self._run(job.poll):
+                if deadline is not None and loop.time() >= deadline:
+                    break
+                await asyncio.sleep(backoff.next())
+
+            # Raises the same errors as the blocking client
+            await self._run(job.result, timeout=0)
+
+        return job
+
+    async def stream_query_result(
+        self, query_result_id, query_id=None, batch_size=STREAM_BATCH_SIZE
+    ):
+        """Yield the rows of a query result as the body arrives.
+
+        Rows are read `batch_size` at a time on the worker pool.
+        """
+
+        stream = await self._run(
+            self.client.stream_query_result, query_result_id, query_id=query_id
+        )
+
+        try:
+            while True:
+                rows = await self._run(_take, stream, batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            await self._run(stream.close)
+
+    async def paginate(self, resource, page=1, page_size=100, **kwargs):
+        """Load all items of a paginated resource.
+
+        `resource` is a coroutine method of this client, e.g. `client.queries`.
+        After the first page reports the total count, the remaining pages are
+        requested concurrently.
+        """
+
+        items = []
+        async for page_items in self.iter_pages(
+            resource, page=page, page_size=page_size, **kwargs
+        ):
+            items.extend(page_items)
+        return items
+
+    async def iter_items(self, resource, page=1, page_size=100, **kwargs):
+        """Yield the items of a paginated resource one at a time."""
+
+        async for page_items in self.iter_pages(
+            resource, page=page, page_size=page_size, **kwargs
+        ):
+            for item in page_items:
+                yield item
+
+    async def iter_pages(self, resource, page=1, page_size=100, **kwargs):
+        """Yield the list of items on each page of a paginated resource, in order."""
+
+        response = await resource(page=page, page_size=page_size, **kwargs)
+        yield response["results"]
+
+        if (
+            not response["results"]
+            or response["page"] * response["page_size"] >= response["count"]
+        ):
+            return
+
+        last_page = math.ceil(response["count"] / response["page_size"])
+        pending = [
+            asyncio.ensure_future(resource(page=p, page_size=page_size, **kwargs))
+            for p in range(page + 1, last_page + 1)
+        ]
+
+        try:
+            for future in pending:
+                response = await future
+                yield response["results"]
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _materialized(func, *args, **kwargs):
+    # Lazy results would make their requests later, on the event loop thread
+    result = func(*args, **kwargs)
+    if isinstance(result, Iterator):
+        return list(result)
+    return result
+
+
+def _take(rows, count):
+    return list(itertools.islice(rows, count))
@@ -0,0 +1,403 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .utils import is_id_segment, path_template, split_path
+
+# Responses that change while a client waits on them are never cached.
+UNCACHED_PREFIXES = ("api/jobs/",)
+
+
+class CacheMiss(Exception):
+    """Raised in offline mode when a request is not in the cache."""
+
+
+class ResponseCache(object):
+    """In-memory TTL/LRU cache for the responses of GET requests.
+
+    Entries expire after `ttl` seconds. `endpoint_ttls` overrides the TTL per
+    path template, e.g. `{"api/queries/{id}": 600, "api/jobs/{id}": 0}`; a TTL
+    of 0 disables caching for that endpoint. Least recently used entries are
+    evicted once the cache holds more than `max_entries` responses or more
+    than `max_bytes` of response bodies.
+
+    A non-GET request through the client invalidates its own path, the paths
+    above it (so `POST api/queries/1` drops cached `api/queries` pages) and,
+    for object paths, the paths below it.
+    """
+
+    offline = False
+
+    # Streamed responses are not kept in memory
+    caches_streams = False
+
+    def __init__(
+        self, ttl=60, endpoint_ttls=None, max_entries=1024, max_bytes=64 * 1024**2
+    ):
+        self.ttl = ttl
+        self.endpoint_ttls = endpoint_ttls or {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+
+        self._entries = OrderedDict()
+        self._keys_by_path = {}
+        self._lock = threading.Lock()
+
+    def ttl_for(self, path):
+        if _is_uncached(path):
+            return 0
+        return self.endpoint_ttls.get(path_template(path), self.ttl)
+
+    def get(self, path, params=None):
+        """Return the cached response for `path` and `params`, or None."""
+
+        key = _cache_key(path, params)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, path, params, response):
+        ttl = self.ttl_for(path)
+        if not ttl:
+            return
+
+        size = len(response.content)
+        if size > self.max_bytes:
+            return
+
+        key = _cache_key(path, params)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (response, time.time() + ttl, size)
+            self._keys_by_path.setdefault(key[0], set()).add(key)
+            self.size += size
+
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """Drop cached responses affected by a write to `path`."""
+
+        segments = split_path(path)
+        affected = {"/".join(segments[:i]) for i in range(1, len(segments) + 1)}
+        base = "/".join(segments)
+
+        with self._lock:
+            if is_id_segment(segments[-1]):
+                affected.update(
+                    p for p in self._keys_by_path if p.startswith(base + "/")
+                )
+
+            for p in affected:
+                for key in list(self._keys_by_path.get(p, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size,
+            }
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+        keys = self._keys_by_path[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_path[key[0]]
+
+
+class DiskCache(object):
+    """SQLite-backed cache of GET responses that survives between runs.
+
+    Responses are stored with the time they were fetched and served again
+    until they are older than `ttl` seconds (forever if `ttl` is None).
+    `namespace`, usually the Redash URL, keeps snapshots of different
+    instances in the same file apart.
+
+    In `offline` mode nothing is sent to the server: cached responses are
+    returned regardless of their age, a GET that is not cached raises
+    `CacheMiss`, and any other request is refused.
+
+    Streamed responses are stored too, so that they can be replayed offline.
+    Their bodies are read in full to store them.
+    """
+
+    caches_streams = True
+
+    def __init__(self, path, ttl=None, offline=False, namespace=""):
+        self.path = path
+        self.ttl = ttl
+        self.offline = offline
+        self.namespace = namespace
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                path TEXT NOT NULL,
+                url TEXT,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                stored_at REAL NOT NULL
+            )""")
+        self._db.commit()
+
+    def get(self, path, params=None):
+        key = self._key(path, params)
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, status, headers, body, stored_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+            is_fresh = row is not None and (
+                self.offline or self.ttl is None or row[4] + self.ttl >= time.time()
+            )
+
+            if not is_fresh:
+                self.misses += 1
+                if self.offline:
+                    raise CacheMiss(
+                        "{} is not in the cache at {}".format(key, self.path)
+                    )
+                return None
+
+            self.hits += 1
+
+        url, status, headers, body, _ = row
+
+        response = requests.Response()
+        response.url = url
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    def set(self, path, params, response):
+        if _is_uncached(path):
+            return
+
+        key = self._key(path, params)
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    self.namespace,
+                    _cache_key(path, params)[0],
+                    response.url,
+                    response.status_code,
+                    json.dumps(dict(response.headers)),
+                    response.content,
+                    time.time(),
+                ),
+            )
+            self._db.commit()
+
+    def invalidate(self, path):
+        segments = split_path(path)
+        affected = ["/".join(segments[:i]) for i in range(1, len(segments) + 1)]
+
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM responses WHERE namespace = ? AND path = ?",
+                [(self.namespace, p) for p in affected],
+            )
+            if is_id_segment(segments[-1]):
+                self._db.execute(
+                    "DELETE FROM responses WHERE namespace = ? AND substr(path, 1, ?) = ?",
+                    (self.namespace, len(affected[-1]) + 1, affected[-1] + "/"),
+                )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM responses WHERE namespace = ?", (self.namespace,)
+            )
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT count(*), coalesce(sum(length(body)), 0) FROM responses WHERE namespace = ?",
+                (self.namespace,),
+            ).fetchone()
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _key(self, path, params):
+        return json.dumps([self.namespace, *_cache_key(path, params)[1:]])
+
+
+class ResultCache(object):
+    """SQLite store of query results keyed by query, query text and parameters.
+
+    A result is found again only for the same query id, the same query text
+    (so editing the query invalidates it) and the same parameter values,
+    whatever their order. Results older than `ttl` seconds are treated as
+    missing; with `ttl=None` they never expire.
+    """
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS query_results (
+                key TEXT PRIMARY KEY,
+                query_id INTEGER NOT NULL,
+                query_result TEXT NOT NULL,
+                stored_at REAL NOT NULL
+            )""")
+        self._db.commit()
+
+    def get(self, query_id, query_text, parameters=None):
+        """Return the stored query result, or None if it is missing or stale."""
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT query_result, stored_at FROM query_results WHERE key = ?",
+                (_result_key(query_id, query_text, parameters),),
+            ).fetchone()
+
+            if row is None or (
+                self.ttl is not None and row[1] + self.ttl < time.time()
+            ):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def set(self, query_id, query_text, parameters, query_result):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO query_results VALUES (?, ?, ?, ?)",
+                (
+                    _result_key(query_id, query_text, parameters),
+                    query_id,
+                    json.dumps(query_result),
+                    time.time(),
+                ),
+            )
+            self._db.commit()
+
+    def clear(self, query_id=None):
+        with self._lock:
+            if query_id is None:
+                self._db.execute("DELETE FROM query_results")
+            else:
+                self._db.execute(
+                    "DELETE FROM query_results WHERE query_id = ?", (query_id,)
+                )
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT count(*), coalesce(sum(length(query_result)), 0) FROM query_results"
+            ).fetchone()
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _is_uncached(path):
+    return "/".join(split_path(path)).startswith(UNCACHED_PREFIXES)
+
+
+def _cache_key(path, params):
+    """(path without query string, full path, params) of a request."""
+
+    params = tuple(sorted((key, str(val)) for key, val in (params or {}).items()))
+    return ("/".join(split_path(path)), path.strip("/"), params)
+
+
+def _result_key(query_id, query_text, parameters):
+    """(query id, hash of the query text, normalized parameters) as JSON."""
+
+    text_hash = hashlib.sha256(query_text.encode("utf-8")).hexdigest()
+    return json.dumps(
+        [query_id, text_hash, _normalize(parameters or {})], sort_keys=True
+    )
+
+
+def _normalize(value):
+    # Redash receives parameter values as text, so 1 and "1" are the same
+    if isinstance(value, dict):
+        return {str(key): _normalize(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(val) for val in value]
+    if value is None:
+        return None
+    return str(value)
@@ -0,0 +1,57 @@
+import functools
+
+import click
+
+from .cache import DiskCache
+
+
+def cache_options(url_param):
+    """Add `--cache`, `--cache-ttl` and `--offline` to a click command.
+
+    The command receives a `cache` argument instead: a `DiskCache` at the
+    `--cache` path, namespaced by the value of its `url_param` argument, or
+    None when `--cache` was not given. Online runs write every response
+    through to the cache and only reuse those younger than `--cache-ttl`
+    seconds (none by default). `--offline` serves everything from it.
+    """
+
+    def decorator(command):
+        @click.option(
+            "--cache",
+            "cache_path",
+            type=click.Path(dir_okay=False),
+            help="Save API responses in this SQLite file to replay them later "
+            "with --offline",
+        )
+        @click.option(
+            "--cache-ttl",
+            type=click.FloatRange(min=0),
+            default=0,
+            show_default=True,
+            help="Reuse cached responses younger than this many seconds instead "
+            "of requesting them again",
+        )
+        @click.option(
+            "--offline",
+            is_flag=True,
+            help="Serve every request from --cache without contacting the server",
+        )
+        @functools.wraps(command)
+        def wrapper(*args, cache_path, cache_ttl, offline, **kwargs):
+            if offline and not cache_path:
+                raise click.UsageError("--offline requires --cache")
+
+            cache = None
+            if cache_path:
+                cache = DiskCache(
+                    cache_path,
+                    ttl=cache_ttl,
+                    offline=offline,
+                    namespace=kwargs[url_param],
+                )
+
+            return command(*args, cache=cache, **kwargs)
+
+        return wrapper
+
+    return decorator
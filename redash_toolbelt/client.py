@@ -1,12 +1,76 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+from .cache import CacheMiss
+from .instrumentation import RequestEvent
+from .jobs import QueryJob
+from .retry import RetryPolicy
+from .columnar import FORMATS as COLUMNAR_FORMATS, write_columnar
+from .streaming import QueryResultStream, copy_body, write_ndjson
+from .utils import path_template
 
 
 class Redash(object):
-    def __init__(self, redash_url, api_key):
+    def __init__(
+        self,
+        redash_url,
+        api_key,
+        concurrency=1,
+        retry=None,
+        rate_limit=None,
+        adapter=None,
+        cache=None,
+        hooks=None,
+    ):
+        """`concurrency` is the number of pages `iter_pages` may have in flight
+        at once after the first page has reported the total item count.
+
+        `retry` is a `RetryPolicy`. By default idempotent requests are retried
+        on 429 and 5xx responses; pass `RetryPolicy(total=0)` to disable it.
+
+        `rate_limit` is an optional `RateLimit` that every request, including
+        retries, waits on before it is sent. Share one instance between all
+        clients that talk to the same server.
+
+        `adapter` is an optional `requests.adapters.HTTPAdapter` to send
+        requests through. Clients mounted on the same adapter share its
+        connection pools; see `ClientPool`.
+
+        `cache` is an optional `ResponseCache` or `DiskCache` for GET requests.
+        Only share one between clients that use the same API key. With an
+        offline `DiskCache` every response comes from the cache. A
+        `DiskCache` also records streamed responses for offline replay, which
+        downloads their bodies in full before they are returned; a
+        `ResponseCache` leaves them streaming.
+
+        `hooks` maps "before" and "after" to lists of callables that receive a
+        `RequestEvent` for every request; see `LatencyCollector`. They can also
+        be appended to `self.hooks` later."""
+
         self.redash_url = redash_url
+        self.concurrency = max(1, concurrency)
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.rate_limit = rate_limit
+        self.cache = cache
+        self.hooks = {
+            "before": list((hooks or {}).get("before", [])),
+            "after": list((hooks or {}).get("after", [])),
+        }
         self.session = requests.Session()
         self.session.headers.update({"Authorization": "Key {}".format(api_key)})
 
+        if adapter is None:
+            adapter = HTTPAdapter(pool_maxsize=max(DEFAULT_POOLSIZE, self.concurrency))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def test_credentials(self):
         try:
             response = self._get("api/session")
@@ -37,6 +101,90 @@ class Redash(object):
         """GET api/queries/<query_id>"""
         return self._get(f"api/queries/{query_id}").json()
 
+    def execute_query(self, query_id, parameters=None, max_age=0):
+        """POST api/queries/<query_id>/results and return a `QueryJob`.
+
+        With `max_age` above 0 Redash may answer with a cached result no older
+        than `max_age` seconds, in which case the job is already done.
+        """
+
+        payload = {"parameters": parameters or {}, "max_age": max_age}
+        response = self._post(f"api/queries/{query_id}/results", json=payload).json()
+
+        return QueryJob(
+            self,
+            query_id,
+            job=response.get("job"),
+            query_result=response.get("query_result"),
+            parameters=parameters,
+        )
+
+    def stream_query_result(self, query_result_id, query_id=None):
+        """GET api/query_results/<query_result_id> as a stream of rows.
+
+        Returns a `QueryResultStream` that decodes rows as the body arrives.
+        Pass `query_id` to read api/queries/<query_id>/results/<id>.json instead.
+        """
+
+        if query_id is None:
+            path = f"api/query_results/{query_result_id}"
+        else:
+            path = f"api/queries/{query_id}/results/{query_result_id}.json"
+
+        return QueryResultStream(self._get(path, stream=True))
+
+    def download_query_result(
+        self, query_result_id, destination, fmt="csv", query_id=None, progress=None
+    ):
+        """Save a query result to `destination`, a path or a binary file.
+
+        With `fmt` "csv" or "json" the body of the .csv or .json result
+        endpoint is written as it arrives. "ndjson" writes one JSON line per
+        row, and "parquet" and "arrow" write columnar files in batches of rows
+        (see `columnar.write_columnar`, which needs pyarrow). Either way memory
+        use does not depend on the size of the result.
+        A file at a path only appears once the download is complete.
+
+        `progress(bytes_downloaded, total_bytes)` is called as the download
+        advances; `total_bytes` is None if the server did not send it.
+        Returns the number of bytes written.
+        """
+
+        if fmt not in ("csv", "json", "ndjson") + COLUMNAR_FORMATS:
+            raise ValueError("Unsupported format {!r}".format(fmt))
+
+        if isinstance(destination, (str, os.PathLike)):
+            tmp_path = "{}.part".format(destination)
+            try:
+                with open(tmp_path, "wb") as fp:
+                    written = self.download_query_result(
+                        query_result_id, fp, fmt, query_id, progress
+                    )
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            os.replace(tmp_path, destination)
+            return written
+
+        if fmt == "ndjson":
+            rows = self.stream_query_result(query_result_id, query_id=query_id)
+            return write_ndjson(rows, destination, progress)
+
+        if fmt in COLUMNAR_FORMATS:
+            start = destination.tell()
+            with self.stream_query_result(query_result_id, query_id=query_id) as rows:
+                write_columnar(rows, destination, fmt, progress=progress)
+            return destination.tell() - start
+
+        if query_id is None:
+            path = f"api/query_results/{query_result_id}.{fmt}"
+        else:
+            path = f"api/queries/{query_id}/results/{query_result_id}.{fmt}"
+
+        return copy_body(self._get(path, stream=True), destination, progress)
+
     def users(self, page=1, page_size=25, only_disabled=False):
         """GET api/users"""
 
@@ -141,7 +289,7 @@ class Redash(object):
 
     def scheduled_queries(self):
         """Loads all queries and returns only the scheduled ones."""
-        queries = self.paginate(self.queries)
+        queries = self.iter_items(self.queries)
         return filter(lambda query: query["schedule"] is not None, queries)
 
     def update_query(self, query_id, data):
@@ -184,20 +332,76 @@ class Redash(object):
     def paginate(self, resource, page=1, page_size=100, **kwargs):
         """Load all items of a paginated resource
 
-        NOTE: This might fail due to rate limit (50/hr, 200/day).
-        TODO: Add backoff?
+        NOTE: This might hit the rate limit (50/hr, 200/day). Rate limited
+        requests are retried according to `self.retry`.
+        """
+
+        return list(self.iter_items(resource, page=page, page_size=page_size, **kwargs))
+
+    def iter_items(self, resource, page=1, page_size=100, **kwargs):
+        """Yield the items of a paginated resource one at a time.
+
+        Pages are requested lazily, so callers can start working on the first
+        items before the last page is downloaded.
+        """
+
+        for items in self.iter_pages(
+            resource, page=page, page_size=page_size, **kwargs
+        ):
+            yield from items
+
+    def iter_pages(self, resource, page=1, page_size=100, **kwargs):
+        """Yield the list of items on each page of a paginated resource.
+
+        Pages are yielded in order. With `concurrency` above 1 the remaining
+        pages are fetched on a thread pool once the first response reports the
+        total count, keeping at most `concurrency` pages in flight.
         """
 
         response = resource(page=page, page_size=page_size, **kwargs)
-        items = response["results"]
 
-        if response["page"] * response["page_size"] >= response["count"]:
-            return items
-        else:
-            return [
-                *items,
-                *self.paginate(resource, page=page + 1, page_size=page_size, **kwargs),
-            ]
+        if self.concurrency == 1:
+            while True:
+                yield response["results"]
+
+                if _is_last_page(response):
+                    return
+
+                page += 1
+                response = resource(page=page, page_size=page_size, **kwargs)
+
+        yield response["results"]
+
+        if _is_last_page(response):
+            return
+
+        last_page = math.ceil(response["count"] / response["page_size"])
+        remaining = iter(range(page + 1, last_page + 1))
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        in_flight = deque()
+
+        def submit_next():
+            next_page = next(remaining, None)
+            if next_page is not None:
+                in_flight.append(
+                    executor.submit(
+                        resource, page=next_page, page_size=page_size, **kwargs
+                    )
+                )
+
+        try:
+            for _ in range(self.concurrency):
+                submit_next()
+
+            while in_flight:
+                response = in_flight.popleft().result()
+                submit_next()
+                yield response["results"]
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def _get(self, path, **kwargs):
         return self._request("GET", path, **kwargs)
@@ -209,7 +413,164 @@ class Redash(object):
         return self._request("DELETE", path, **kwargs)
 
     def _request(self, method, path, **kwargs):
-        url = "{}/{}".format(self.redash_url, path)
-        response = self.session.request(method, url, **kwargs)
-        response.raise_for_status()
+        if self.hooks["before"]:
+            event = RequestEvent(method, path, path_template(path), *[None] * 6)
+            for hook in self.hooks["before"]:
+                hook(event)
+
+        if self.cache is not None and self.cache.offline:
+            if method != "GET":
+                raise CacheMiss("Cannot {} {} in offline mode".format(method, path))
+            return self._cached(method, path, kwargs)
+
+        use_cache = self.cache is not None and (
+            not kwargs.get("stream") or getattr(self.cache, "caches_streams", False)
+        )
+
+        if use_cache and method == "GET":
+            response = self._cached(method, path, kwargs)
+            if response is not None:
+                return response
+
+        response = self._send(method, path, **kwargs)
+
+        if use_cache and method == "GET":
+            self.cache.set(path, kwargs.get("params"), response)
+        elif use_cache:
+            self.cache.invalidate(path)
+
         return response
+
+    def _cached(self, method, path, kwargs):
+        started = time.perf_counter()
+        response = self.cache.get(path, kwargs.get("params"))
+
+        if response is not None:
+            self._after_request(method, path, response, started, 0, cached=True)
+
+        return response
+
+    def _send(self, method, path, **kwargs):
+        url = "{}/{}".format(self.redash_url, path)
+        started = time.perf_counter()
+        response = None
+        attempt = 0
+
+        try:
+            while True:
+                if self.rate_limit is not None:
+                    self.rate_limit.acquire()
+
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                ):
+                    response = None
+                    if not self.retry.should_retry(method, attempt):
+                        raise
+                    delay = self.retry.backoff(attempt)
+                else:
+                    if not self.retry.should_retry(
+                        method, attempt, response.status_code
+                    ):
+                        response.raise_for_status()
+                        return response
+                    delay = self.retry.backoff(attempt, response)
+                    response.close()
+
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            self._after_request(method, path, response, started, attempt)
+
+    def _after_request(self, method, path, response, started, retries, cached=False):
+        if not self.hooks["after"]:
+            return
+
+        status = request_bytes = response_bytes = None
+
+        if response is not None:
+            status = response.status_code
+            if response.request is not None and response.request.body is not None:
+                request_bytes = len(response.request.body)
+            if response._content_consumed:
+                response_bytes = len(response.content or b"")
+            elif "Content-Length" in response.headers:
+                response_bytes = int(response.headers["Content-Length"])
+
+        event = RequestEvent(
+            method,
+            path,
+            path_template(path),
+            status,
+            time.perf_counter() - started,
+            request_bytes,
+            response_bytes,
+            retries,
+            cached,
+        )
+
+        for hook in self.hooks["after"]:
+            hook(event)
+
+
+class ClientPool(object):
+    """Hands out one `Redash` client per (url, api_key) and reuses it.
+
+    All clients from a pool send their requests through a single
+    `HTTPAdapter`, which keeps one connection pool of up to `pool_size`
+    keep-alive connections per host. Switching between users' API keys then
+    costs neither a new client nor a new TCP/TLS handshake. Cookies and
+    headers stay per client.
+
+    Keyword arguments are passed to every `Redash` the pool creates.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOLSIZE, **client_kwargs):
+        self.adapter = _SharedAdapter(pool_maxsize=pool_size)
+        self.client_kwargs = client_kwargs
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, redash_url, api_key, **client_kwargs):
+        """Return the client for `redash_url` and `api_key`, creating it on first use.
+
+        `client_kwargs` override the pool's defaults and are only used when
+        the client is created.
+        """
+
+        key = (redash_url, api_key)
+
+        with self._lock:
+            if key not in self._clients:
+                kwargs = dict(self.client_kwargs, **client_kwargs)
+                self._clients[key] = Redash(
+                    redash_url, api_key, adapter=self.adapter, **kwargs
+                )
+            return self._clients[key]
+
+    def close(self):
+        """Close every client and then the shared connection pools."""
+
+        with self._lock:
+            for client in self._clients.values():
+                client.session.close()
+            self._clients.clear()
+        HTTPAdapter.close(self.adapter)
+
+
+class _SharedAdapter(HTTPAdapter):
+    # Closing a session closes the adapters mounted on it. The connections of
+    # a pool's adapter are shared by all of its clients, so only
+    # `ClientPool.close` closes them.
+    def close(self):
+        pass
+
+
+def _is_last_page(response):
+    return (
+        not response["results"]
+        or response["page"] * response["page_size"] >= response["count"]
+    )
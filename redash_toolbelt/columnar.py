@@ -0,0 +1,186 @@
+import json
+import re
+from datetime import date, datetime, timedelta, timezone
+
+# Rows converted and written at a time. Each batch becomes one Parquet row
+# group or one Arrow record batch.
+BATCH_SIZE = 64 * 1024
+
+FORMATS = ("parquet", "arrow")
+
+# The ISO 8601 timestamps Redash sends, with or without fractional seconds
+# and an offset
+ISO_DATETIME = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?"
+    r"\s*(Z|[+-]\d\d(?::?\d\d)?)?$"
+)
+
+
+def write_columnar(
+    rows,
+    fp,
+    fmt="parquet",
+    columns=None,
+    types=None,
+    batch_size=BATCH_SIZE,
+    progress=None,
+):
+    """Write query result rows to the binary file `fp` as Parquet or as an
+    Arrow IPC file (readable with `pyarrow.feather` / `pandas.read_feather`).
+
+    `rows` is an iterable of row dicts, usually a `QueryResultStream`.
+    The schema comes from `columns`, the result's column list, which is
+    read from the stream when not given. Redash column types map to Arrow
+    types; `types` ({column name: Redash type}) overrides them, e.g. to
+    keep a column Redash guessed wrong as "string". Datetimes are stored in
+    UTC. Rows are converted and written `batch_size` at a time, so memory
+    use depends on the batch size rather than the size of the result.
+
+    If `rows` is a stream, `progress(bytes_downloaded, total_bytes)` is
+    called after each batch. Requires pyarrow. Returns the number of rows
+    written.
+    """
+
+    pa = _import_pyarrow()
+
+    if fmt not in FORMATS:
+        raise ValueError("Unsupported format {!r}".format(fmt))
+
+    rows = iter(rows)
+    first = next(rows, None)
+
+    if columns is None:
+        # Streams know the columns once the first row has been read
+        columns = getattr(rows, "columns", None) or []
+        if not columns and first is not None:
+            columns = [{"name": name} for name in first]
+
+    types = types or {}
+    names = [col["name"] for col in columns]
+    redash_types = [
+        types.get(name, col.get("type")) for name, col in zip(names, columns)
+    ]
+    schema = pa.schema(
+        [(name, _arrow_type(pa, t)) for name, t in zip(names, redash_types)]
+    )
+    converters = [CONVERTERS.get(t, _to_string) for t in redash_types]
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(fp, schema)
+        write = writer.write_table
+        to_table = pa.Table.from_arrays
+    else:
+        writer = pa.ipc.new_file(fp, schema)
+        write = writer.write_batch
+        to_table = pa.RecordBatch.from_arrays
+
+    count = 0
+    batch = [] if first is None else [first]
+
+    def flush():
+        arrays = [
+            pa.array([convert(row.get(name)) for row in batch], type=field.type)
+            for name, convert, field in zip(names, converters, schema)
+        ]
+        write(to_table(arrays, schema=schema))
+
+        if progress and hasattr(rows, "bytes_read"):
+            progress(rows.bytes_read, rows.total_bytes)
+
+    try:
+        for row in rows:
+            if len(batch) == batch_size:
+                flush()
+                count += len(batch)
+                batch = []
+            batch.append(row)
+
+        if batch:
+            flush()
+            count += len(batch)
+    finally:
+        writer.close()
+
+    return count
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(
+            "Parquet and Arrow export requires pyarrow: "
+            "pip install 'redash-toolbelt[columnar]'"
+        )
+    return pyarrow
+
+
+def _arrow_type(pa, redash_type):
+    return {
+        "integer": pa.int64(),
+        "float": pa.float64(),
+        "boolean": pa.bool_(),
+        "date": pa.date32(),
+        "datetime": pa.timestamp("us", tz="UTC"),
+    }.get(redash_type, pa.string())
+
+
+def _to_int(value):
+    return None if value is None else int(value)
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ("true", "t", "1", "yes")
+    return None if value is None else bool(value)
+
+
+def _to_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+
+def _to_datetime(value):
+    if value is None:
+        return None
+
+    match = ISO_DATETIME.match(value.strip())
+    if match is None:
+        raise ValueError("Not an ISO 8601 datetime: {!r}".format(value))
+
+    *fields, fraction, offset = match.groups()
+    year, month, day, hour, minute, second = (int(f or 0) for f in fields)
+    microsecond = int((fraction or "0").ljust(6, "0"))
+
+    tz = timezone.utc
+    if offset and offset != "Z":
+        sign = -1 if offset[0] == "-" else 1
+        digits = offset[1:].replace(":", "").ljust(4, "0")
+        tz = timezone(sign * timedelta(hours=int(digits[:2]), minutes=int(digits[2:])))
+
+    value = datetime(year, month, day, hour, minute, second, microsecond, tzinfo=tz)
+    return value.astimezone(timezone.utc)
+
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+CONVERTERS = {
+    "integer": _to_int,
+    "float": _to_float,
+    "boolean": _to_bool,
+    "date": _to_date,
+    "datetime": _to_datetime,
+}
@@ -1,133 +1,312 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
 from collections import namedtuple
+from functools import lru_cache
 
+DateRange = namedtuple('DateRange', 'start end')
 
-def get_frontend_vals():
-	'''Returns a named tuple of dynamic date ranges that match Redash's front-end
-	'''
+Values = namedtuple('Values', ' '.join([
+    'd_this_week', 'd_this_month', 'd_this_year',
+    'd_last_week', 'd_last_month', 'd_last_year',
+    'd_last_7_days', 'd_last_14_days', 'd_last_30_days', 'd_last_60_days',
+    'd_last_90_days', 'd_now', 'd_yesterday',
+]))
 
-	ranges = calculate_ranges()
-	singles = calculate_singletons()
 
-	valkeys = [k for k in ranges.keys()] + [k for k in singles.keys()]
+def get_frontend_vals(reference=None, week_start=0):
+    '''Returns a named tuple of dynamic date ranges that match Redash's front-end
 
-	Values = namedtuple('Values', ' '.join(valkeys))
+    Ranges are relative to the `reference` date or datetime, today by default.
+    Weeks start on `week_start`, 0 for Monday through 6 for Sunday.
+    '''
 
-	return Values(**ranges, **singles)
+    return _frontend_vals(get_reference(reference).date(), week_start)
 
-def calculate_ranges():
+@lru_cache(maxsize=1024)
+def _frontend_vals(day, week_start):
 
-	# SuperToday is more specific than datetime.datetime.today
-	SuperToday = namedtuple('SuperToday', 'month day year weeknum weekday')
-	DateRange = namedtuple('DateRange', 'start end')
+    ranges = calculate_ranges(day, week_start)
+    singles = calculate_singletons(day)
 
-	today = datetime.today()
-	_ymd = (today.month, today.day)
+    return Values(**ranges, **singles)
 
-	t = SuperToday(*_ymd, *today.isocalendar())
 
-	ranges = {}
+class DynamicDates(object):
+    '''Fills in the dynamic date values of query parameters
 
-	#  _____ _     _      __        __        _     
-	# |_   _| |__ (_)___  \ \      / /__  ___| | __ 
-	#   | | | '_ \| / __|  \ \ /\ / / _ \/ _ \ |/ / 
-	#   | | | | | | \__ \   \ V  V /  __/  __/   <  
-	#   |_| |_| |_|_|___/    \_/\_/ \___|\___|_|\_\ 
+    "Today" is taken in `timezone`, a tzinfo or an IANA name such as
+    "Europe/Berlin" (local time by default), and weeks start on `week_start`.
+    The values for a day are computed once and shared by every resolver.
+    '''
 
-	start = datetime.strptime(f"{t.year}-{t.weeknum}-1", '%G-%V-%u')
-	end = start + timedelta(days=6)
+    def __init__(self, timezone=None, week_start=0):
+        if isinstance(timezone, str):
+            timezone = get_timezone(timezone)
 
-	ranges['d_this_week'] = DateRange(start,end)
+        self.timezone = timezone
+        self.week_start = week_start
 
-											
-	#  _____ _     _       __  __             _   _      
-	# |_   _| |__ (_)___  |  \/  | ___  _ __ | |_| |__   
-	#   | | | '_ \| / __| | |\/| |/ _ \| '_ \| __| '_ \  
-	#   | | | | | | \__ \ | |  | | (_) | | | | |_| | | | 
-	#   |_| |_| |_|_|___/ |_|  |_|\___/|_| |_|\__|_| |_| 
+    def today(self):
+        return datetime.now(self.timezone).date()
 
-	start = datetime.strptime(f"{t.year}-{t.month}-1", '%Y-%m-%d')
-	e_year, e_month = (t.year,t.month+1) if t.month < 12 else (t.year+1,1)
-	end = datetime.strptime(
-		f"{e_year}-{e_month}-1", '%Y-%m-%d') \
-		- timedelta(days=1)
+    def values(self, reference=None):
+        if reference is None:
+            reference = self.today()
+        return get_frontend_vals(reference, self.week_start)
 
-	ranges['d_this_month'] = DateRange(start,end)
-											  
-	#  _____ _     _      __   __                    
-	# |_   _| |__ (_)___  \ \ / /__  __ _ _ __       
-	#   | | | '_ \| / __|  \ V / _ \/ _` | '__|      
-	#   | | | | | | \__ \   | |  __/ (_| | |         
-	#   |_| |_| |_|_|___/   |_|\___|\__,_|_|         
+    def resolve(self, parameters, reference=None):
+        '''Returns {name: value} for a query's list of parameters
+        '''
 
-	start = datetime.strptime(f"{t.year}-1-1", '%Y-%m-%d')
-	end = datetime.strptime(f"{t.year}-12-31", '%Y-%m-%d')
+        values = self.values(reference)
+        return {p.get('name'): resolve_parameter(values, p) for p in parameters}
 
-	ranges['d_this_year'] = DateRange(start,end)
 
-												  
-	#  _              _    __        __        _       
-	# | |    __ _ ___| |_  \ \      / /__  ___| | __   
-	# | |   / _` / __| __|  \ \ /\ / / _ \/ _ \ |/ /   
-	# | |__| (_| \__ \ |_    \ V  V /  __/  __/   <    
-	# |_____\__,_|___/\__|    \_/\_/ \___|\___|_|\_\   
+def get_timezone(name):
+    '''Returns the tzinfo for an IANA timezone name such as "Europe/Berlin"
 
-	start = datetime.strptime(f"{t.year}-{t.weeknum-1}-1", '%G-%V-%u')
-	end = start + timedelta(days=6)
+    Uses zoneinfo on Python 3.9+, and backports.zoneinfo or python-dateutil
+    on older versions. Raises ValueError if the name is unknown or none of
+    them is installed.
+    '''
 
-	ranges['d_last_week'] = DateRange(start,end)
+    try:
+        from zoneinfo import ZoneInfo
+    except ImportError:
+        try:
+            from backports.zoneinfo import ZoneInfo
+        except ImportError:
+            ZoneInfo = None
 
+    if ZoneInfo is not None:
+        try:
+            return ZoneInfo(name)
+        except (KeyError, ValueError):
+            # ZoneInfoNotFoundError is a KeyError
+            raise ValueError('Unknown timezone {!r}'.format(name))
 
-	#  _              _     __  __             _   _      
-	# | |    __ _ ___| |_  |  \/  | ___  _ __ | |_| |__   
-	# | |   / _` / __| __| | |\/| |/ _ \| '_ \| __| '_ \  
-	# | |__| (_| \__ \ |_  | |  | | (_) | | | | |_| | | | 
-	# |_____\__,_|___/\__| |_|  |_|\___/|_| |_|\__|_| |_| 
+    try:
+        from dateutil import tz
+    except ImportError:
+        raise ValueError(
+            'Timezone names need Python 3.9+, backports.zoneinfo or python-dateutil'
+        )
 
+    timezone = tz.gettz(name)
+    if timezone is None:
+        raise ValueError('Unknown timezone {!r}'.format(name))
+    return timezone
 
-	s_year, s_month = (t.year-1, 12) if t.month == 1 else (t.year,t.month-1)
 
-	start = datetime.strptime(f"{s_year}-{s_month}-1", '%Y-%m-%d')
-	end = datetime.strptime(f"{t.year}-{t.month}-1", '%Y-%m-%d') \
-		- timedelta(days=1)
+def resolve_parameter(values, param):
+    '''Returns the value of a parameter, with dynamic dates looked up in `values`
 
-	ranges['d_last_month'] = DateRange(start, end)
+    If the parameter is not a date type, or its value is not a dynamic value,
+    then the value is returned unchanged.
+    '''
 
-	#  _              _    __   __                   
-	# | |    __ _ ___| |_  \ \ / /__  __ _ _ __      
-	# | |   / _` / __| __|  \ V / _ \/ _` | '__|     
-	# | |__| (_| \__ \ |_    | |  __/ (_| | |        
-	# |_____\__,_|___/\__|   |_|\___|\__,_|_|        
+    value = param.get('value')
+    if 'date' not in (param.get('type') or '') or value not in Values._fields:
+        return value
 
-	start = datetime.strptime(f"{t.year-1}-1-1", '%Y-%m-%d')
-	end = datetime.strptime(f"{t.year-1}-12-31", '%Y-%m-%d')
+    dyn_val = getattr(values, value)
 
-	ranges['d_last_year'] = DateRange(start,end)
+    if isinstance(dyn_val, DateRange):
+        return dict(start=format_date(dyn_val.start), end=format_date(dyn_val.end))
+    return format_date(dyn_val)
 
+def format_date(date_obj):
+    return date_obj.strftime('%Y-%m-%d')
 
-	 #  _              _    __  __  ____                   
-	 # | |    __ _ ___| |_  \ \/ / |  _ \  __ _ _   _ ___  
-	 # | |   / _` / __| __|  \  /  | | | |/ _` | | | / __| 
-	 # | |__| (_| \__ \ |_   /  \  | |_| | (_| | |_| \__ \ 
-	 # |_____\__,_|___/\__| /_/\_\ |____/ \__,_|\__, |___/ 
-	 #                                          |___/      
+def get_reference(reference=None):
+    '''Returns `reference` as a datetime, or datetime.today() if it is None
+    '''
 
-	def make_x_days_date_range(today, days):
-		start = today - timedelta(days=days)
-		end = today
+    if reference is None:
+        return datetime.today()
+    if not isinstance(reference, datetime):
+        return datetime.combine(reference, time())
+    return reference
 
-		return DateRange(start, end)
+def calculate_ranges(reference=None, week_start=0):
 
-	for x in [7, 14, 30, 60, 90]:
-		ranges[f"d_last_{x}_days"] = make_x_days_date_range(today, x)
+    today = get_reference(reference)
+    t = today.date()
 
-	return ranges
+    ranges = {}
 
-def calculate_singletons():
+    #  _____ _     _      __        __        _     
+    # |_   _| |__ (_)___  \ \      / /__  ___| | __ 
+    #   | | | '_ \| / __|  \ \ /\ / / _ \/ _ \ |/ / 
+    #   | | | | | | \__ \   \ V  V /  __/  __/   <  
+    #   |_| |_| |_|_|___/    \_/\_/ \___|\___|_|\_\ 
 
-	today = datetime.today()
-	d_now=datetime.strptime(
-		f"{today.year}-{today.month}-{today.day}", '%Y-%m-%d')
-	d_yesterday = d_now - timedelta(days=1)
+    # Counting back from the reference date keeps weeks that straddle new
+    # year in the right year.
+    days_into_week = (t.weekday() - week_start) % 7
+    this_week = datetime.combine(t - timedelta(days=days_into_week), time())
 
-	return dict(d_now=d_now, d_yesterday=d_yesterday)
+    start = this_week
+    end = start + timedelta(days=6)
+
+    ranges['d_this_week'] = DateRange(start,end)
+
+                                            
+    #  _____ _     _       __  __             _   _      
+    # |_   _| |__ (_)___  |  \/  | ___  _ __ | |_| |__   
+    #   | | | '_ \| / __| | |\/| |/ _ \| '_ \| __| '_ \  
+    #   | | | | | | \__ \ | |  | | (_) | | | | |_| | | | 
+    #   |_| |_| |_|_|___/ |_|  |_|\___/|_| |_|\__|_| |_| 
+
+    start = datetime.strptime(f"{t.year}-{t.month}-1", '%Y-%m-%d')
+    e_year, e_month = (t.year,t.month+1) if t.month < 12 else (t.year+1,1)
+    end = datetime.strptime(
+        f"{e_year}-{e_month}-1", '%Y-%m-%d') \
+        - timedelta(days=1)
+
+    ranges['d_this_month'] = DateRange(start,end)
+                                              
+    #  _____ _     _      __   __                    
+    # |_   _| |__ (_)___  \ \ / /__  __ _ _ __       
+    #   | | | '_ \| / __|  \ V / _ \/ _` | '__|      
+    #   | | | | | | \__ \   | |  __/ (_| | |         
+    #   |_| |_| |_|_|___/   |_|\___|\__,_|_|         
+
+    start = datetime.strptime(f"{t.year}-1-1", '%Y-%m-%d')
+    end = datetime.strptime(f"{t.year}-12-31", '%Y-%m-%d')
+
+    ranges['d_this_year'] = DateRange(start,end)
+
+                                                  
+    #  _              _    __        __        _       
+    # | |    __ _ ___| |_  \ \      / /__  ___| | __   
+    # | |   / _` / __| __|  \ \ /\ / / _ \/ _ \ |/ /   
+    # | |__| (_| \__ \ |_    \ V  V /  __/  __/   <    
+    # |_____\__,_|___/\__|    \_/\_/ \___|\___|_|\_\   
+
+    start = this_week - timedelta(days=7)
+    end = start + timedelta(days=6)
+
+    ranges['d_last_week'] = DateRange(start,end)
+
+
+    #  _              _     __  __             _   _      
+    # | |    __ _ ___| |_  |  \/  | ___  _ __ | |_| |__   
+    # | |   / _` / __| __| | |\/| |/ _ \| '_ \| __| '_ \  
+    # | |__| (_| \__ \ |_  | |  | | (_) | | | | |_| | | | 
+    # |_____\__,_|___/\__| |_|  |_|\___/|_| |_|\__|_| |_| 
+
+
+    s_year, s_month = (t.year-1, 12) if t.month == 1 else (t.year,t.month-1)
+
+    start = datetime.strptime(f"{s_year}-{s_month}-1", '%Y-%m-%d')
+    end = datetime.strptime(f"{t.year}-{t.month}-1", '%Y-%m-%d') \
+        - timedelta(days=1)
+
+    ranges['d_last_month'] = DateRange(start, end)
+
+    #  _              _    __   __                   
+    # | |    __ _ ___| |_  \ \ / /__  __ _ _ __      
+    # | |   / _` / __| __|  \ V / _ \/ _` | '__|     
+    # | |__| (_| \__ \ |_    | |  __/ (_| | |        
+    # |_____\__,_|___/\__|   |_|\___|\__,_|_|        
+
+    start = datetime.strptime(f"{t.year-1}-1-1", '%Y-%m-%d')
+    end = datetime.strptime(f"{t.year-1}-12-31", '%Y-%m-%d')
+
+    ranges['d_last_year'] = DateRange(start,end)
+
+
+     #  _              _    __  __  ____                   
+     # | |    __ _ ___| |_  \ \/ / |  _ \  __ _ _   _ ___  
+     # | |   / _` / __| __|  \  /  | | | |/ _` | | | / __| 
+     # | |__| (_| \__ \ |_   /  \  | |_| | (_| | |_| \__ \ 
+     # |_____\__,_|___/\__| /_/\_\ |____/ \__,_|\__, |___/ 
+     #                                          |___/      
+
+    def make_x_days_date_range(today, days):
+        start = today - timedelta(days=days)
+        end = today
+
+        return DateRange(start, end)
+
+    for x in [7, 14, 30, 60, 90]:
+        ranges[f"d_last_{x}_days"] = make_x_days_date_range(today, x)
+
+    return ranges
+
+def calculate_singletons(reference=None):
+
+    today = get_reference(reference)
+    d_now=datetime.strptime(
+        f"{today.year}-{today.month}-{today.day}", '%Y-%m-%d')
+    d_yesterday = d_now - timedelta(days=1)
+
+    return dict(d_now=d_now, d_yesterday=d_yesterday)
+
+
+# ┌───────────────────────────────────────────┐
+# │                                           │
+# │      ________           _____             │
+# │      ___  __/_____________  /________     │
+# │      __  /  _  _ \_  ___/  __/_  ___/     │
+# │      _  /   /  __/(__  )/ /_ _(__  )      │
+# │      /_/    \___//____/ \__/ /____/       │
+# │                                           │
+# │                                           │
+# └───────────────────────────────────────────┘
+
+
+def _dates(date_range):
+    return format_date(date_range.start), format_date(date_range.end)
+
+
+def test_1():
+
+    # Friday 2021-01-01: the week started in the previous year
+    values = get_frontend_vals(datetime(2021, 1, 1, 15, 30))
+
+    assert _dates(values.d_this_week) == ('2020-12-28', '2021-01-03')
+    assert _dates(values.d_last_week) == ('2020-12-21', '2020-12-27')
+    assert _dates(values.d_last_month) == ('2020-12-01', '2020-12-31')
+    assert _dates(values.d_this_year) == ('2021-01-01', '2021-12-31')
+    assert _dates(values.d_last_year) == ('2020-01-01', '2020-12-31')
+    assert format_date(values.d_yesterday) == '2020-12-31'
+
+
+def test_2():
+
+    # Weeks starting on Sunday
+    values = get_frontend_vals(datetime(2021, 1, 1), week_start=6)
+
+    assert _dates(values.d_this_week) == ('2020-12-27', '2021-01-02')
+    assert _dates(values.d_last_week) == ('2020-12-20', '2020-12-26')
+
+    values = get_frontend_vals(datetime(2021, 1, 3), week_start=6)
+
+    assert _dates(values.d_this_week) == ('2021-01-03', '2021-01-09')
+    assert _dates(values.d_last_week) == ('2020-12-27', '2021-01-02')
+
+
+def test_3():
+
+    # Week 53 of 2020 as the ISO calendar counts it
+    values = get_frontend_vals(datetime(2021, 1, 4))
+
+    assert _dates(values.d_this_week) == ('2021-01-04', '2021-01-10')
+    assert _dates(values.d_last_week) == ('2020-12-28', '2021-01-03')
+
+
+def test_4():
+
+    parameters = [
+        {'name': 'week', 'type': 'date-range', 'value': 'd_last_week'},
+        {'name': 'day', 'type': 'date', 'value': 'd_yesterday'},
+        {'name': 'text', 'type': 'text', 'value': 'd_yesterday'},
+    ]
+    resolved = DynamicDates(week_start=6).resolve(parameters, date(2024, 3, 1))
+
+    assert resolved == {
+        'week': {'start': '2024-02-18', 'end': '2024-02-24'},
+        'day': '2024-02-29',
+        'text': 'd_yesterday',
+    }
@@ -0,0 +1,189 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import click
+from redash_toolbelt import DynamicDates, JobTracker, Redash
+from redash_toolbelt.jobs import SUCCESS
+from redash_toolbelt.examples.refresh_dashboard import (
+    get_params,
+    get_queries_on_dashboard,
+)
+
+
+def backfill(
+    client,
+    queries,
+    dates,
+    out_dir,
+    fmt="csv",
+    concurrency=4,
+    timeout=None,
+    dynamic_dates=None,
+):
+    """Run every query in `queries` once for each date in `dates`.
+
+    Dynamic date parameters such as `d_last_week` are resolved by
+    `dynamic_dates` as if each date were today. At most `concurrency` executions run at a time, and each
+    result is streamed to `out_dir/query_<id>/<date>.<fmt>` as soon as it is
+    ready. Returns the number of runs that failed.
+    """
+
+    dynamic_dates = dynamic_dates or DynamicDates()
+    tracker = JobTracker(client, max_in_flight=concurrency, timeout=timeout)
+
+    for day in dates:
+        for query_id, query in queries.items():
+            tracker.submit(
+                query_id,
+                parameters=get_params(dynamic_dates, query, day),
+                context=day,
+            )
+
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        downloads = []
+
+        for job in tracker.as_completed():
+            if job.status != SUCCESS:
+                print(
+                    f"Query: {job.query_id} -- {job.context:%Y-%m-%d} -- "
+                    f"failed: {job.job.get('error')}"
+                )
+                failed += 1
+                continue
+
+            path = os.path.join(
+                out_dir, f"query_{job.query_id}", f"{job.context:%Y-%m-%d}.{fmt}"
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            downloads.append((job, path, executor.submit(job.download, path, fmt)))
+
+        for job, path, future in downloads:
+            try:
+                size = future.result()
+                print(
+                    f"Query: {job.query_id} -- {job.context:%Y-%m-%d} -- {size} bytes"
+                )
+            except Exception as e:
+                print(f"Query: {job.query_id} -- {path} -- could not save: {e}")
+                failed += 1
+
+    return failed
+
+
+def date_sequence(start, end, step):
+    if step < 1:
+        raise ValueError("step must be at least 1 day, got {}".format(step))
+
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=step)
+
+
+@click.command()
+@click.argument("url")
+@click.argument("key")
+@click.option(
+    "--query",
+    "query_ids",
+    type=int,
+    multiple=True,
+    help="Query to run. Can be repeated",
+)
+@click.option("--dashboard", "slug", help="Run every query on this dashboard")
+@click.option(
+    "--start", type=click.DateTime(["%Y-%m-%d"]), required=True, help="First date"
+)
+@click.option(
+    "--end", type=click.DateTime(["%Y-%m-%d"]), required=True, help="Last date"
+)
+@click.option(
+    "--step",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Days between dates",
+)
+@click.option(
+    "--out-dir",
+    type=click.Path(file_okay=False),
+    default=".",
+    show_default=True,
+    help="Results are written to OUT_DIR/query_<id>/<date>.<format>",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "ndjson", "parquet", "arrow"]),
+    default="csv",
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="How many queries may run at the same time",
+)
+@click.option(
+    "--timeout", type=float, help="Cancel runs that take longer than this many seconds"
+)
+@click.option(
+    "--week-start",
+    type=click.IntRange(0, 6),
+    default=0,
+    show_default=True,
+    help="First day of the week for This Week and Last Week, 0 is Monday",
+)
+def main(
+    url,
+    key,
+    query_ids,
+    slug,
+    start,
+    end,
+    step,
+    out_dir,
+    fmt,
+    concurrency,
+    timeout,
+    week_start,
+):
+    """Run queries as of every date from START to END and save each result.
+
+    Dynamic date parameters (This Week, Last Month, ...) are resolved
+    relative to each date.
+    """
+
+    if not query_ids and not slug:
+        raise click.UsageError("Pass --query and/or --dashboard")
+
+    client = Redash(url, key, concurrency=concurrency)
+
+    queries = {query_id: client.get_query(query_id) for query_id in query_ids}
+    if slug:
+        queries.update(get_queries_on_dashboard(client, slug))
+
+    dates = list(date_sequence(start, end, step))
+    print(f"Running {len(queries)} queries for {len(dates)} dates")
+
+    failed = backfill(
+        client,
+        queries,
+        dates,
+        out_dir,
+        fmt=fmt,
+        concurrency=concurrency,
+        timeout=timeout,
+        dynamic_dates=DynamicDates(week_start=week_start),
+    )
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,34 @@
+import csv
+import hashlib
 import itertools
 import json
+import os
 import re
+import sqlite3
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 import click
 import pytest
 
 from redash_toolbelt import Redash
+from redash_toolbelt.cli import cache_options
 
 
-def find_table_names(url, key, data_source_id):
+def find_table_names(
+    url, key, data_source_id, cache=None, jobs=1, extraction_cache=None
+):
 
-    client = Redash(url, key)
+    client = Redash(url, key, cache=cache)
 
-    schema_tables = [
+    schema = SchemaIndex(
         token.get("name")
         for token in client._get(f"api/data_sources/{data_source_id}/schema")
         .json()
         .get("schema", [])
-    ]
+    )
 
     queries = [
         query
@@ -25,85 +36,447 @@ def find_table_names(url, key, data_source_id):
         if query.get("data_source_id", None) == int(data_source_id)
     ]
 
+    extracted = extract_all(
+        [query["query"] for query in queries], jobs=jobs, cache=extraction_cache
+    )
+
+    # Without a schema every reference is kept as written. Otherwise
+    # references are reported by their name in the schema, so `"Users"` and
+    # `public.users` count as the same table.
     tables_by_qry = {
-        query["id"]: [
-            table
-            for table in extract_table_names(query["query"])
-            if table in schema_tables or len(schema_tables) == 0
-        ]
-        for query in queries
+        query["id"]: (
+            list(dict.fromkeys(filter(None, map(schema.match, tables))))
+            if len(schema)
+            else tables
+        )
+        for query, tables in zip(queries, extracted)
     }
 
     return tables_by_qry
 
 
-def format_query(str_sql):
-    """Strips all newlines, excess whitespace, and spaces around commas"""
+# One part of a qualified name: "quoted", `quoted`, [quoted] or bare
+NAME_PART = re.compile(r'"((?:[^"]|"")*)"|`([^`]*)`|\[([^\]]*)\]|([^."`\[]+)')
+
+
+def normalize_name(name):
+    """Returns the lowercased, unquoted parts of a possibly qualified name.
+
+    `"Sales"."Orders"`, `[sales].[orders]` and `sales.ORDERS` all become
+    ("sales", "orders"). Backticks may quote several parts at once, as in
+    BigQuery's `project.dataset.table`.
+    """
+
+    parts = []
+    for match in NAME_PART.finditer(name):
+        double, backtick, bracket, bare = match.groups()
+        if backtick is not None:
+            parts.extend(backtick.split("."))
+        elif double is not None:
+            parts.append(double.replace('""', '"'))
+        else:
+            parts.append(bracket if bracket is not None else bare)
+
+    return tuple(part.strip().lower() for part in parts if part.strip())
+
 
-    stage1 = str_sql.replace("\n", " ")
-    stage2 = re.sub(r"\s+", " ", stage1).strip()
-    stage3 = re.sub(r"(\s*,\s*)", ",", stage2)
+class SchemaIndex(object):
+    """Looks up table references in a data source's schema in constant time.
 
-    return stage3
+    `match` returns the schema's name for a reference, or None. References
+    are compared after `normalize_name`, so quoting and case do not matter,
+    and a qualified reference matches a less qualified schema name
+    (`public.users` finds `users`). An unqualified reference matches a
+    qualified schema name (`users` finds `app.users`) as long as only one
+    schema name ends that way.
+    """
+
+    def __init__(self, names):
+        self.names = set(names)
+        self._exact = {}
+        self._suffixes = {}
+
+        for name in self.names:
+            parts = normalize_name(name)
+            self._exact.setdefault(parts, name)
+
+            for i in range(1, len(parts)):
+                suffix = parts[i:]
+                # None marks suffixes shared by several names
+                if self._suffixes.setdefault(suffix, name) != name:
+                    self._suffixes[suffix] = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, reference):
+        return self.match(reference) is not None
+
+    def match(self, reference):
+        if reference in self.names:
+            return reference
+
+        parts = normalize_name(reference)
+        for i in range(len(parts)):
+            name = self._exact.get(parts[i:])
+            if name is not None:
+                return name
+
+        return self._suffixes.get(parts)
+
+
+# Bump whenever a change to extract_table_names changes its results, so that
+# results cached by an ExtractionCache are computed again.
+EXTRACTOR_VERSION = 3
+
+# One SQL token per match. Comments, string literals and quoted identifiers
+# are matched whole, so keywords inside them are never seen as structure.
+# Backslash is an ordinary character in standard strings ('C:\' is complete)
+# and only escapes in Postgres E'...' strings.
+SQL_TOKEN = re.compile(
+    r"""
+    \s*
+    (?:(?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+    |(?P<string>'(?:[^']|'')*'?|[eE]'(?:[^'\\]|\\.|'')*'?
+        |\$(?P<tag>\w*)\$.*?(?:\$(?P=tag)\$|\Z))
+    |(?P<quoted>"(?:[^"]|"")*"?|`(?:[^`]|``)*`?|\[[^\]]*\]?)
+    |(?P<param>\{\{.*?\}\})
+    |(?P<word>[\w$#@]+)
+    |(?P<punct>.))
+    """,
+    flags=re.VERBOSE | re.DOTALL,
+)
+
+# Keywords that end a FROM clause
+END_OF_FROM = set(
+    """WHERE GROUP ORDER HAVING LIMIT UNION EXCEPT INTERSECT MINUS WINDOW QUALIFY
+    OFFSET FETCH FOR RETURNING SELECT SET VALUES PREWHERE SETTINGS FORMAT INTO""".split()
+)
+
+# Keywords that can follow a table reference and so are not its alias
+NOT_AN_ALIAS = END_OF_FROM | set(
+    """JOIN INNER LEFT RIGHT FULL OUTER CROSS NATURAL ON USING WITH TABLESAMPLE
+    PIVOT UNPIVOT LATERAL STRAIGHT_JOIN ANTI SEMI ASOF GLOBAL ANY ALL ARRAY
+    PARTITION SAMPLE FINAL AS""".split()
+)
 
 
 def extract_table_names(str_sql):
+    """Returns the tables a query reads, in order of first appearance.
+
+    The query is tokenized in a single pass. Names are taken after FROM and
+    JOIN and from comma-separated FROM lists, and keep their quoting and
+    schema prefix (`[dbo].[table]`, `schema.table`). Text in comments and
+    string literals, names defined with WITH, table functions and the FROM in
+    expressions like `EXTRACT(YEAR FROM col)` are not table references.
+    """
+
+    tables = []
+    cte_names = set()
+
+    # One frame per level of parentheses. `query` tells whether FROM starts
+    # a table list at this level: None until the first token is seen.
+    frame = _Frame(query=True)
+    stack = [frame]
+    prev = None
+
+    for match in SQL_TOKEN.finditer(str_sql):
+        kind = match.lastgroup
+        if kind == "comment":
+            continue
+
+        text = match.group(kind)
+        word = text.upper() if kind == "word" else None
+
+        if frame.query is None:
+            frame.query = word in ("SELECT", "WITH")
+
+        frame.tokens += 1
+        expect = frame.expect
+
+        if expect == "table":
+            if kind in ("word", "quoted") and word not in ("SELECT", "WITH", "VALUES"):
+                if word not in ("LATERAL", "ONLY"):
+                    frame.parts = [text]
+                    frame.expect = "name"
+                continue
+            if text == "(":
+                # A subquery, or parentheses around joins
+                frame.expect = "alias"
+                frame = _Frame(query=True, expect="table")
+                stack.append(frame)
+                continue
+            frame.expect = None
+
+        elif expect == "name":
+            if text == ".":
+                frame.expect = "name_part"
+                continue
+            if text == "(":
+                # A table function such as generate_series(...)
+                frame.expect = "alias"
+                frame = _Frame(query=None)
+                stack.append(frame)
+                continue
+            tables.append(".".join(frame.parts))
+            frame.expect = expect = "alias"
+
+        elif expect == "name_part":
+            frame.expect = None
+            if kind in ("word", "quoted"):
+                frame.parts.append(text)
+                frame.expect = "name"
+                continue
+
+        elif expect == "cte_name":
+            if word == "RECURSIVE":
+                continue
+            frame.expect = None
+            if kind in ("word", "quoted"):
+                cte_names.add(_unquote(text).lower())
+                frame.expect = "cte_as"
+                continue
+
+        elif expect == "cte_as":
+            if word in ("AS", "NOT", "MATERIALIZED"):
+                frame.as_seen = frame.as_seen or word == "AS"
+                continue
+            if text == "(":
+                # The column list, or the body once AS has been seen
+                if frame.as_seen:
+                    frame.expect = "cte_next"
+                    frame.as_seen = False
+                    frame = _Frame(query=None)
+                else:
+                    frame = _Frame(query=False)
+                stack.append(frame)
+                continue
+            frame.expect = None
+
+        elif expect == "cte_next":
+            frame.expect = None
+            if text == ",":
+                frame.expect = "cte_name"
+                continue
+
+        if expect == "alias" and frame.expect == "alias":
+            frame.expect = None
+            if kind == "quoted" or (kind == "word" and word not in NOT_AN_ALIAS):
+                continue
+            if word == "AS":
+                frame.expect = "alias"
+                continue
+
+        if text == "(":
+            frame = _Frame(query=None)
+            stack.append(frame)
+        elif text == ")":
+            if len(stack) > 1:
+                stack.pop()
+                frame = stack[-1]
+        elif text == ";":
+            frame = _Frame(query=True)
+            stack = [frame]
+        elif text == "," and frame.in_from:
+            frame.expect = "table"
+        elif word == "WITH" and frame.query and frame.tokens == 1:
+            frame.expect = "cte_name"
+        elif word == "FROM" and frame.query:
+            # Not the FROM of `a IS [NOT] DISTINCT FROM b`
+            if prev != "DISTINCT":
+                frame.expect = "table"
+                frame.in_from = True
+        elif word == "JOIN" and frame.query and prev != "ARRAY":
+            frame.expect = "table"
+            frame.in_from = True
+        elif word in END_OF_FROM:
+            frame.in_from = False
+
+        prev = word
+
+    if frame.expect == "name":
+        tables.append(".".join(frame.parts))
+
+    found = {}
+    for table in tables:
+        if "." in table or _unquote(table).lower() not in cte_names:
+            found.setdefault(table)
+
+    return list(found)
+
+
+def extract_all(texts, jobs=1, cache=None):
+    """Runs extract_table_names on every query text, in `jobs` processes.
+
+    Texts are handed to the processes in chunks and the results come back
+    in the order of `texts`. `jobs=0` uses every CPU. With an
+    `ExtractionCache`, only texts it has not seen before are parsed.
+    """
+
+    if cache is not None:
+        hashes = [text_hash(text) for text in texts]
+        known = cache.get_many(hashes)
+        missing = {h: text for h, text in zip(hashes, texts) if h not in known}
+
+        parsed = dict(zip(missing, extract_all(list(missing.values()), jobs)))
+        cache.set_many(parsed)
+        known.update(parsed)
+
+        return [known[h] for h in hashes]
+
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(texts) < 2:
+        return [extract_table_names(text) for text in texts]
+
+    # A few chunks per process keeps them all busy until the end without
+    # paying for a round trip per query.
+    chunksize = max(1, len(texts) // (jobs * 4))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(extract_table_names, texts, chunksize=chunksize))
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache(object):
+    """Table names extracted from query texts, kept in SQLite between runs.
+
+    Results are keyed by a hash of the query text and `EXTRACTOR_VERSION`.
+    Once more than `max_entries` are stored, the least recently used are
+    evicted.
+    """
+
+    # SQLite allows at most 999 parameters per statement in older versions
+    BATCH = 500
+
+    def __init__(self, path, max_entries=200000):
+        self.max_entries = max_entries
+
+        self._db = sqlite3.connect(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS extractions (
+                hash TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                tables TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (hash, version)
+            )""")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS extractions_used_at ON extractions (used_at)"
+        )
 
-    fmt_sql = format_query(str_sql)
+        # Results of other extractor versions can never be used again
+        self._db.execute(
+            "DELETE FROM extractions WHERE version != ?", (EXTRACTOR_VERSION,)
+        )
+        self._db.commit()
+
+    def get_many(self, hashes):
+        """Return {hash: tables} for the hashes that are cached."""
+
+        found = {}
+        now = time.time()
+
+        for batch in _batches(list(set(hashes)), self.BATCH):
+            marks = ",".join("?" * len(batch))
+            rows = self._db.execute(
+                f"SELECT hash, tables FROM extractions WHERE version = ? AND hash IN ({marks})",
+                (EXTRACTOR_VERSION, *batch),
+            ).fetchall()
+            found.update((h, json.loads(tables)) for h, tables in rows)
+
+            self._db.execute(
+                f"UPDATE extractions SET used_at = ? WHERE version = ? AND hash IN ({marks})",
+                (now, EXTRACTOR_VERSION, *batch),
+            )
+
+        self._db.commit()
+        return found
+
+    def set_many(self, tables_by_hash):
+        now = time.time()
+
+        self._db.executemany(
+            "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?)",
+            [
+                (h, EXTRACTOR_VERSION, json.dumps(tables), now)
+                for h, tables in tables_by_hash.items()
+            ],
+        )
+        self._db.execute(
+            """DELETE FROM extractions WHERE rowid IN (
+                SELECT rowid FROM extractions ORDER BY used_at
+                LIMIT max(0, (SELECT count(*) FROM extractions) - ?)
+            )""",
+            (self.max_entries,),
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class _Frame(object):
+    __slots__ = ("query", "expect", "in_from", "parts", "as_seen", "tokens")
 
-    # This pattern captures all text that immdiately follows a FROM or JOIN
-    # keyword except whitespace and parentheses. It effectively removes table
-    # aliases like "<table> as t" or "<table> t"
-    PATTERN = re.compile(
-        r"(?:FROM|JOIN)(?:\s+)([^\s\(\)]+)", flags=re.IGNORECASE | re.UNICODE
+    def __init__(self, query, expect=None):
+        self.query = query
+        self.expect = expect
+        self.in_from = expect == "table"
+        self.parts = None
+        self.as_seen = False
+        self.tokens = 0
+
+
+def _unquote(name):
+    if name[:1] in ('"', "`", "[") and len(name) > 1:
+        return name[1:-1]
+    return name
+
+
+def count_queries_by_table(tables_by_qry):
+    """Returns a Counter of the number of queries that reference each table.
+
+    Each query's tables are counted once, in a single pass over all of them.
+    """
+
+    return Counter(
+        itertools.chain.from_iterable(map(dict.fromkeys, tables_by_qry.values()))
     )
 
-    regex_matches = [match for match in re.findall(PATTERN, fmt_sql)]
 
-    # For test_6: expand any comma-delimitted matches
-    split_matches = [i.split(",") for i in regex_matches]
-    flattened_split_matches = [i for i in itertools.chain(*split_matches)]
+def summary_rows(tables_by_qry):
+    """Yields (table, number of queries) pairs, most referenced first"""
 
-    # For test_8 and test_9: expand aliased comma-delimitted matches
-    #   1. Find all text between FROM->WHERE and FROM->JOIN keywords
-    #   2. Replace any commas with `FROM` keywords
-    #   3. Apply the same PATTERN match used above which ignores aliases
-    after_from_before_keyword = [
-        match for match in re.findall(r"(?:FROM)(.*)(?:WHERE|JOIN)", fmt_sql)
-    ]
-    sub_keyword_for_comma = [
-        segment.replace(",", " FROM ") for segment in after_from_before_keyword
-    ]
-    sub_regex_matches = [
-        re.findall(PATTERN, format_query(i)) for i in sub_keyword_for_comma
-    ]
+    return iter(count_queries_by_table(tables_by_qry).most_common())
 
-    flattened_sub_matches = [
-        i
-        for i in itertools.chain(*sub_regex_matches)
-        if i not in flattened_split_matches
-    ]
 
-    return [*flattened_split_matches, *flattened_sub_matches]
+def detail_rows(tables_by_qry):
+    """Yields (query_id, table) pairs"""
+
+    for query, tables in tables_by_qry.items():
+        for table in tables:
+            yield query, table
 
 
 def print_summary(tables_by_qry):
     """Builds a summary showing table names and count of queries that reference them."""
 
-    summary = {
-        table_name: sum(
-            [1 for tables in tables_by_qry.values() if table_name in tables]
-        )
-        for table_name in itertools.chain(*tables_by_qry.values())
-    }
+    summary = list(summary_rows(tables_by_qry))
 
-    align = max([len(table_name) for table_name in summary.keys()])
+    align = max([len(table_name) for table_name, _ in summary], default=5)
 
     print("\n")
     print(f"{'table':>{align}} | {'number of queries':>17}")
     print("-" * align + " | " + "-" * 17)
 
-    for t, num in sorted(summary.items(), key=lambda item: item[1], reverse=True):
+    for t, num in summary:
         print(f"{t:>{align}} | {num:>17}")
 
     print("\n")
@@ -112,25 +485,99 @@ def print_summary(tables_by_qry):
 def print_details(tables_by_qry):
     """Prints out (query_id, tablename) tuples"""
 
-    details = [
-        [(query, table) for table in tables] for query, tables in tables_by_qry.items()
-    ]
-
-    for row in itertools.chain(*details):
+    for row in detail_rows(tables_by_qry):
         print(",".join([str(i) for i in row]))
 
 
+SUMMARY_FIELDS = ("table", "query_count")
+DETAIL_FIELDS = ("query_id", "table")
+
+
+def write_rows(rows, fields, fmt, fp):
+    """Writes `rows` of `fields` values to `fp` as csv, json or ndjson.
+
+    Rows are written as they come, so output starts before the last row
+    is ready and the rows are never held in memory. `json` writes one array
+    of objects.
+    """
+
+    if fmt == "csv":
+        writer = csv.writer(fp)
+        writer.writerow(fields)
+        writer.writerows(rows)
+    elif fmt == "ndjson":
+        for row in rows:
+            fp.write(json.dumps(dict(zip(fields, row))) + "\n")
+    elif fmt == "json":
+        fp.write("[")
+        for i, row in enumerate(rows):
+            fp.write(",\n" if i else "\n")
+            fp.write(json.dumps(dict(zip(fields, row))))
+        fp.write("\n]\n")
+    else:
+        raise ValueError("Unsupported format {!r}".format(fmt))
+
+
 @click.command()
 @click.argument("url",)
 @click.argument("key",)
 @click.argument("data_source_id")
 @click.option("--detail", is_flag=True, help="Prints out all table/query pairs?")
-def main(url, key, data_source_id, detail):
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["text", "csv", "json", "ndjson"]),
+    default="text",
+    show_default=True,
+    help="Write the summary or the details as csv, json or ndjson instead of "
+    "plain text",
+)
+@cache_options("url")
+@click.option(
+    "--extraction-cache",
+    "extraction_cache_path",
+    type=click.Path(dir_okay=False),
+    help="Keep extracted table names in this SQLite file so that later runs "
+    "only parse new or edited queries",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="Extract table names in this many processes. 0 uses every CPU",
+)
+def main(
+    url,
+    key,
+    data_source_id,
+    detail,
+    fmt,
+    cache,
+    extraction_cache_path,
+    jobs,
+):
     """Find table names referenced in queries against DATA_SOURCE_ID"""
 
-    data = find_table_names(url, key, data_source_id)
+    extraction_cache = (
+        ExtractionCache(extraction_cache_path) if extraction_cache_path else None
+    )
+    data = find_table_names(
+        url,
+        key,
+        data_source_id,
+        cache=cache,
+        jobs=jobs,
+        extraction_cache=extraction_cache,
+    )
 
-    if detail:
+    if fmt != "text":
+        if detail:
+            write_rows(detail_rows(data), DETAIL_FIELDS, fmt, sys.stdout)
+        else:
+            write_rows(summary_rows(data), SUMMARY_FIELDS, fmt, sys.stdout)
+    elif detail:
         print_details(data)
     else:
         print_summary(data)
@@ -266,3 +713,106 @@ def test_9():
     expected = ["table1", "table2", "table3", "table4", "table5"]
 
     assert len(tables) == len(expected) and all([i in expected for i in tables])
+
+
+def test_10():
+
+    sql = """
+    SELECT field FROM table0 -- LEFT JOIN commented_out
+    /* JOIN also_commented_out */
+    WHERE field = 'FROM not_a_table'
+    """
+
+    tables = extract_table_names(sql)
+    expected = ["table0"]
+
+    assert len(tables) == len(expected) and all([i in expected for i in tables])
+
+
+def test_11():
+
+    sql = """
+    WITH cte0 AS (SELECT field FROM table0),
+    cte1 (field) AS (SELECT field FROM cte0 JOIN table1 ON cte0.field = table1.field)
+    SELECT field FROM cte1, table2
+    """
+
+    tables = extract_table_names(sql)
+    expected = ["table0", "table1", "table2"]
+
+    assert len(tables) == len(expected) and all([i in expected for i in tables])
+
+
+def test_12():
+
+    sql = """
+    SELECT field FROM (SELECT field FROM table0) AS sub
+    JOIN (SELECT field FROM schema.table1 t WHERE t.field > 0) b ON sub.field = b.field
+    """
+
+    tables = extract_table_names(sql)
+    expected = ["table0", "schema.table1"]
+
+    assert len(tables) == len(expected) and all([i in expected for i in tables])
+
+
+def test_13():
+
+    sql = """
+    SELECT EXTRACT(YEAR FROM created_at), TRIM(BOTH ' ' FROM field)
+    FROM "schema"."Table 0" LEFT JOIN `project.dataset.table1` USING (field)
+    WHERE field IS DISTINCT FROM other_field
+    """
+
+    tables = extract_table_names(sql)
+    expected = ['"schema"."Table 0"', "`project.dataset.table1`"]
+
+    assert len(tables) == len(expected) and all([i in expected for i in tables])
+
+
+def test_14():
+
+    sql = """
+    SELECT field FROM generate_series(1, 10) AS s(field), table0
+    JOIN table1 ON table0.field = table1.field, table2
+    """
+
+    tables = extract_table_names(sql)
+    expected = ["table0", "table1", "table2"]
+
+    assert len(tables) == len(expected) and all([i in expected for i in tables])
+
+
+def test_15():
+
+    schema = SchemaIndex(["users", "Sales.Orders", "app.events", "other.events"])
+
+    assert schema.match('"Users"') == "users"
+    assert schema.match("public.users") == "users"
+    assert schema.match("[sales].[orders]") == "Sales.Orders"
+    assert schema.match("orders") == "Sales.Orders"
+    assert schema.match("APP.events") == "app.events"
+    # Ambiguous without the schema name
+    assert schema.match("events") is None
+    assert schema.match("missing") is None
+
+
+def test_16():
+
+    tables_by_qry = {1: ["a", "b", "a"], 2: ["b"], 3: []}
+
+    assert dict(summary_rows(tables_by_qry)) == {"a": 1, "b": 2}
+    assert list(detail_rows(tables_by_qry)) == [(1, "a"), (1, "b"), (1, "a"), (2, "b")]
+
+
+def test_17():
+
+    sql = r"""
+    SELECT * FROM table0 WHERE path = 'C:\' AND note = E'it\'s'
+    UNION ALL SELECT * FROM table1 JOIN table2 ON 1 = 1
+    """
+
+    tables = extract_table_names(sql)
+    expected = ["table0", "table1", "table2"]
+
+    assert len(tables) == len(expected) and all([i in expected for i in tables])
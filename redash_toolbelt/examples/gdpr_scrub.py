@@ -1,6 +1,9 @@
+import itertools
+
 import click
 
 from redash_toolbelt import Redash
+from redash_toolbelt.cli import cache_options
 
 
 class Lookup(object):
@@ -12,9 +15,25 @@ class Lookup(object):
         if not query_result_id:
             return False
 
-        result = self.redash._get("api/query_results/{}".format(query_result_id))
+        if not self.email_list:
+            return False
+
+        # Scan the body as it arrives instead of holding large results in
+        # memory. Keep the end of each chunk so matches across chunks count.
+        needles = [email.encode("utf-8") for email in self.email_list]
+        overlap = max(len(needle) for needle in needles) - 1
+        tail = b""
+
+        with self.redash._get(
+            "api/query_results/{}".format(query_result_id), stream=True
+        ) as result:
+            for chunk in result.iter_content(chunk_size=64 * 1024):
+                window = tail + chunk.lower()
+                if any(needle in window for needle in needles):
+                    return True
+                tail = window[max(0, len(window) - overlap) :]
 
-        return any([email in result.text.lower() for email in self.email_list])
+        return False
 
     def check_query(self, query):
 
@@ -76,19 +95,31 @@ class Lookup(object):
 
         return found_in_dashboard or found_in_widget or found_in_tags
 
+    def iter_with_count(self, resource, page_size=100):
+        """Returns the item count of a paginated resource and an iterator over
+        its items. The remaining pages are loaded as the items are consumed.
+        """
+
+        first = resource(page=1, page_size=page_size)
+        rest = ()
+        if len(first["results"]) < first["count"]:
+            rest = self.redash.iter_items(resource, page=2, page_size=page_size)
+
+        return first["count"], itertools.chain(first["results"], rest)
+
     def lookup(self):
-        queries = self.redash.paginate(self.redash.queries)
+        count, queries = self.iter_with_count(self.redash.queries)
 
-        with click.progressbar(queries, label="Queries") as bar:
+        with click.progressbar(queries, length=count, label="Queries") as bar:
             found_q = [query for query in bar if self.check_query(query)]
 
         for query in found_q:
             query_url = "{}/queries/{}".format(self.redash.redash_url, query["id"])
             print(query_url)
 
-        dashboards = self.redash.paginate(self.redash.dashboards)
+        count, dashboards = self.iter_with_count(self.redash.dashboards)
 
-        with click.progressbar(dashboards, label="Dashboards") as bar:
+        with click.progressbar(dashboards, length=count, label="Dashboards") as bar:
             found_d = [dash for dash in bar if self.check_dashboard(dash)]
 
         for dash in found_d:
@@ -107,10 +138,11 @@ class Lookup(object):
     prompt="API Key",
     help="User API Key",
 )
-def lookup(redash_host, email, api_key):
+@cache_options("redash_host")
+def lookup(redash_host, email, api_key, cache):
     """Search for EMAIL in queries and query results, output query URL if found."""
 
-    redash = Redash(redash_host, api_key)
+    redash = Redash(redash_host, api_key, cache=cache)
     lookup = Lookup(redash, email)
     lookup.lookup()
 
@@ -7,7 +7,7 @@ Notes:
 
 import sys, os, json, logging, textwrap, re, traceback
 import click
-from redash_toolbelt import Redash
+from redash_toolbelt import ClientPool, LatencyCollector, RateLimit, ResponseCache
 
 logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
 logging.getLogger("requests").setLevel("ERROR")
@@ -577,7 +577,7 @@ def import_queries(orig_client, dest_client):
 
             print("Query {} - OK  - importing".format(origin_id))
 
-            user_client = Redash(DESTINATION, user_api_key)
+            user_client = make_client(DESTINATION, user_api_key)
 
             try:
                 response = user_client.create_query(data)
@@ -646,7 +646,7 @@ def fix_queries(orig_client, dest_client):
             orig_user_id,
             dest_client,
         )["api_key"]
-        user_client = Redash(dest_client.redash_url, user_api_key)
+        user_client = make_client(dest_client.redash_url, user_api_key)
         user_client.update_query(new_query_id, {"options": options})
 
         meta["flags"]["fixed_queries"].append(new_query_id)
@@ -679,7 +679,7 @@ def import_visualizations(orig_client, dest_client):
 
         try:
             dest_user_api_key = user_with_api_key(orig_user_id, dest_client)["api_key"]
-            user_client = Redash(DESTINATION, dest_user_api_key)
+            user_client = make_client(DESTINATION, dest_user_api_key)
         except UserNotFoundException as e:
             print("Query {} - FAIL - Visualizations skipped: ".format(query_id, e))
             continue
@@ -762,7 +762,7 @@ def import_dashboards(orig_client, dest_client):
             print("Dashboard {} - FAIL - {}".format(d["slug"], e))
             continue
 
-        user_client = Redash(DESTINATION, user_api_key)
+        user_client = make_client(DESTINATION, user_api_key)
 
         new_dashboard = user_client.create_dashboard(d["name"])
 
@@ -872,7 +872,7 @@ def import_alerts(orig_client, dest_client):
                 # This is a user subscription
                 dest_user = meta["users"][sub["user"]["id"]]
                 user_dest_api_key = dest_user["api_key"]
-                dest_user_client = Redash(DESTINATION, user_dest_api_key)
+                dest_user_client = make_client(DESTINATION, user_dest_api_key)
                 dest_user_client._post(
                     f"api/alerts/{dest_id}/subscriptions",
                     json=subscriptions_base_kwargs,
@@ -891,8 +891,8 @@ def import_favorites(orig_client, dest_client):
             print(f"User {user_dest['email']} is disabled. Skipping import.")
             continue
 
-        orig_user_client = Redash(ORIGIN, user_orig_api_key)
-        dest_user_client = Redash(DESTINATION, user_dest_api_key)
+        orig_user_client = make_client(ORIGIN, user_orig_api_key)
+        dest_user_client = make_client(DESTINATION, user_dest_api_key)
 
         favorite_queries = orig_user_client.paginate(
             orig_user_client.queries, only_favorites=True
@@ -970,7 +970,7 @@ def fix_csv_queries(orig_client, dest_client):
         new_text = f'url: "{old_text}"'
 
         user_api_key = get_api_key(dest_client, query["user"]["id"])
-        user_client = Redash(DESTINATION, user_api_key)
+        user_client = make_client(DESTINATION, user_api_key)
         user_client.update_query(query_id, {"query": new_text})
 
         meta["fix_csv_queries"][query_id] = True
@@ -1041,6 +1041,29 @@ def convert_schedule(schedule):
     return schedule_json
 
 
+def make_client(url, api_key, **kwargs):
+    """Return the pooled client for this user, which shares connections and the
+    rate limit budget with every other client for the same instance."""
+
+    return CLIENTS.get(url, api_key, rate_limit=RATE_LIMITS.get(url), **kwargs)
+
+
+def make_rate_limit(url):
+    """Build a RateLimit from the `rate_limit` setting, or None if it is unset."""
+
+    settings = meta["settings"].get("rate_limit") or {}
+    rates = {key: settings.get(key) for key in ("per_second", "per_hour", "per_day")}
+
+    if not any(rates.values()):
+        return None
+
+    return RateLimit(
+        **rates,
+        state_file=settings.get("state_file") or "rate_limit.json",
+        name=url,
+    )
+
+
 def get_api_key(client, user_id):
     response = client._get(f"api/users/{user_id}")
 
@@ -1102,6 +1125,13 @@ base_meta = {
         "destination_url": "",
         "destination_admin_api_key": "",
         "preserve_invite_links": True,
+        "rate_limit": {
+            "per_second": None,
+            "per_hour": None,
+            "per_day": None,
+            "state_file": "rate_limit.json",
+        },
+        "pool_size": 10,
     },
 }
 
@@ -1261,6 +1291,8 @@ def make_global_meta():
     global DESTINATION_API_KEY
     global PRESERVE_INVITE_LINKS
     global DATA_SOURCES
+    global RATE_LIMITS
+    global CLIENTS
 
     meta = get_meta()
     meta["users"] = cast_keys_to_int(meta["users"])
@@ -1285,13 +1317,27 @@ def make_global_meta():
     PRESERVE_INVITE_LINKS = meta["settings"]["preserve_invite_links"]
     DATA_SOURCES = meta["data_sources"]
 
+    # Every client for the same instance draws from the same budget
+    RATE_LIMITS = {url: make_rate_limit(url) for url in {ORIGIN, DESTINATION}}
+    CLIENTS = ClientPool(pool_size=meta["settings"].get("pool_size") or 10)
+
 
 @click.command()
 @click.argument(
     "command",
 )
+@click.option(
+    "--timings",
+    is_flag=True,
+    help="Print per-endpoint request counts and latency percentiles at exit",
+)
+@click.option(
+    "--timings-json",
+    type=click.Path(dir_okay=False),
+    help="Write per-endpoint request counts and latency percentiles to this file",
+)
 @click.version_option(version="0.1.9")
-def main(command):
+def main(command, timings, timings_json):
     """Redash migration tool. Can be used to migrate objects (users, queries, visualizations, dashboards, alerts, and favorites)
     from one Redash instance to another.
 
@@ -1377,8 +1423,15 @@ def main(command):
     if command == "init":
         return init()
 
-    from_client = Redash(ORIGIN, ORIGIN_API_KEY)
-    to_client = Redash(DESTINATION, DESTINATION_API_KEY)
+    if timings or timings_json:
+        collector = LatencyCollector()
+        collector.report_at_exit(json_path=timings_json, show_summary=timings)
+        CLIENTS.client_kwargs["hooks"] = {"after": [collector]}
+
+    # The origin instance is never modified, so its responses can be kept for
+    # the whole run. Destination responses are dropped when the admin writes.
+    from_client = make_client(ORIGIN, ORIGIN_API_KEY, cache=ResponseCache(ttl=3600))
+    to_client = make_client(DESTINATION, DESTINATION_API_KEY, cache=ResponseCache())
 
     command_map = {
         "data-sources": import_data_sources,
@@ -1,5 +1,6 @@
 import click
 import requests
+from redash_toolbelt.cli import cache_options
 from redash_toolbelt.client import Redash
 
 template = u"""/*
@@ -36,9 +37,10 @@ def save_queries(queries):
     prompt="API Key",
     help="User API Key",
 )
-def main(redash_url, api_key):
-    redash = Redash(redash_url, api_key)
-    queries = redash.paginate(redash.queries)
+@cache_options("redash_url")
+def main(redash_url, api_key, cache):
+    redash = Redash(redash_url, api_key, cache=cache)
+    queries = redash.iter_items(redash.queries)
     save_queries(queries)
 
 
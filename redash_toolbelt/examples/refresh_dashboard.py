@@ -1,91 +1,271 @@
-import click
-from redash_toolbelt import Redash, get_frontend_vals
-
-
-def refresh_dashboard(baseurl, apikey, slug):
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-    client = Redash(baseurl, apikey)
-    todays_dates = get_frontend_vals()
+import click
+from redash_toolbelt import DynamicDates, Redash
+from redash_toolbelt.jobs import SUCCESS
+from redash_toolbelt.refresh import (
+    FreshnessPolicy,
+    fetch_upstream,
+    refresh_in_order,
+    results_data_sources,
+)
+
+# Number of query definitions fetched at the same time
+CONCURRENCY = 8
+
+
+def refresh_dashboard(
+    baseurl,
+    apikey,
+    slug,
+    wait=False,
+    max_per_data_source=2,
+    timeout=None,
+    upstream=False,
+    freshness=None,
+    dates=None,
+):
+
+    freshness = freshness or FreshnessPolicy()
+    dates = dates or DynamicDates()
+    client = Redash(baseurl, apikey, concurrency=CONCURRENCY)
     queries_dict = get_queries_on_dashboard(client, slug)
 
+    if wait or upstream:
+        results_sources = results_data_sources(client)
+
+        if upstream:
+            fetch_upstream(
+                client,
+                queries_dict,
+                concurrency=CONCURRENCY,
+                results_sources=results_sources,
+            )
+
+        return refresh_and_wait(
+            client,
+            queries_dict,
+            dates,
+            max_per_data_source,
+            timeout,
+            freshness,
+            results_sources,
+        )
+
     # loop through each query and its JSON data
     for idx, qry in queries_dict.items():
 
-        params = {
-            p.get("name"): fill_dynamic_val(todays_dates, p)
-            for p in qry["options"].get("parameters", [])
-        }
+        params = get_params(dates, qry)
 
-        # Pass max_age to ensure a new result is provided.
-        body = {"parameters": params, "max_age": 0}
+        # Redash only re-executes the query if its latest result is older
+        # than max_age. 0, the default, ensures a new result is provided.
+        body = {"parameters": params, "max_age": freshness.max_age_for(qry)}
 
         r = client._post(f"api/queries/{idx}/results", json=body)
 
-        print(f"Query: {idx} -- Code {r.status_code}")
+        if "query_result" in r.json():
+            print(f"Query: {idx} -- Code {r.status_code} -- fresh")
+        else:
+            print(f"Query: {idx} -- Code {r.status_code}")
 
 
-def get_queries_on_dashboard(client, slug):
+def refresh_and_wait(
+    client,
+    queries_dict,
+    dates,
+    max_per_data_source,
+    timeout=None,
+    freshness=None,
+    results_sources=None,
+):
+    """Refresh every query and wait until all of them have finished.
 
-    # Get a list of queries on this dashboard
-    dash = client.dashboard(slug=slug)
+    Queries that read the results of other queries in `queries_dict` run
+    after them. Redash runs queries of a data source one after another, so
+    at most `max_per_data_source` refreshes per data source are in flight at
+    a time. Prints the queue time and runtime of each query as it finishes
+    and returns the number of queries that failed.
+    """
 
-    # Dashboards have visualization and text box widgets. Get the viz widgets.
-    viz_widgets = [i for i in dash["widgets"] if "visualization" in i.keys()]
+    jobs = refresh_in_order(
+        client,
+        queries_dict,
+        params_for=lambda qry: get_params(dates, qry),
+        max_in_flight=max(1, len(queries_dict)),
+        max_per_data_source=max_per_data_source,
+        timeout=timeout,
+        freshness=freshness,
+        results_sources=results_sources,
+    )
 
-    # Visualizations are tied to queries
-    l_query_ids = [i["visualization"]["query"]["id"] for i in viz_widgets]
+    started = time.time()
+    failed = 0
 
-    return {id: client._get(f"api/queries/{id}").json() for id in l_query_ids}
+    for job in jobs:
+        if job.status == SUCCESS and job.id is None:
+            outcome = "fresh"
+        elif job.status == SUCCESS:
+            outcome = "done"
+        else:
+            outcome = "failed: {}".format(job.job.get("error"))
+            failed += 1
 
+        print(
+            f"Query: {job.query_id} -- {outcome} -- "
+            f"queued {format_seconds(job.submitted_at, job.started_at)}, "
+            f"ran {format_seconds(job.started_at, job.finished_at)}"
+        )
 
-def fill_dynamic_val(dates, p):
-    """Accepts parameter default information from the Redash API.
+    print(
+        f"Refreshed {len(queries_dict) - failed}/{len(queries_dict)} queries "
+        f"in {time.time() - started:.1f}s"
+    )
 
-    If the default value is not a date type, or its value cannot be calculated,
-    then the default value is returned unchanged.
+    return failed
 
-	Otherwise, the dynamic value is retrieved from the dates param and returned
-	"""
 
-    if not is_dynamic_param(dates, p):
-        return p.get("value")
-    dyn_val = getattr(dates, p.get("value"))
+def get_params(dates, qry, reference=None):
+    """Parameter values of `qry`, with dynamic dates resolved by `dates`."""
 
-    if is_date_range(dyn_val):
-        return format_date_range(dyn_val)
-    else:
-        return format_date(dyn_val)
+    return dates.resolve(qry["options"].get("parameters", []), reference)
 
 
-def is_dynamic_param(dates, param):
+def format_seconds(start, end):
 
-    return "date" in param.get("type") and param.get("value") in dates._fields
+    if start is None or end is None:
+        return "-"
+    return f"{end - start:.1f}s"
 
 
-def is_date_range(value):
-    return hasattr(value, "start") and hasattr(value, "end")
+def parse_ages(values):
+    """Turn NAME=SECONDS options into a {NAME: seconds} dict."""
 
+    ages = {}
+    for value in values:
+        name, sep, seconds = value.rpartition("=")
+        if not sep or not seconds.isdigit():
+            raise click.BadParameter(f"{value} is not NAME=SECONDS")
+        ages[name] = int(seconds)
+    return ages
 
-def format_date(date_obj):
-    return date_obj.strftime("%Y-%m-%d")
 
+def get_queries_on_dashboard(client, slug):
 
-def format_date_range(date_range_obj):
+    # Get a list of queries on this dashboard
+    dash = client.dashboard(slug=slug)
 
-    start = format_date(date_range_obj.start)
-    end = format_date(date_range_obj.end)
+    # Dashboards have visualization and text box widgets. Get the viz widgets.
+    viz_widgets = [i for i in dash["widgets"] if "visualization" in i.keys()]
+
+    # Visualizations are tied to queries. Several widgets can show the same one.
+    l_query_ids = [i["visualization"]["query"]["id"] for i in viz_widgets]
+    l_query_ids = list(dict.fromkeys(l_query_ids))
 
-    return dict(start=start, end=end)
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        queries = executor.map(client.get_query, l_query_ids)
+        return dict(zip(l_query_ids, queries))
 
 
 @click.command()
 @click.argument("url",)
 @click.argument("key",)
 @click.argument("slug",)
-def main(url, key, slug):
+@click.option(
+    "--wait",
+    is_flag=True,
+    help="Wait for every query to finish and print how long each one took",
+)
+@click.option(
+    "--max-per-data-source",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="With --wait, how many queries of one data source may run at once",
+)
+@click.option(
+    "--timeout",
+    type=float,
+    help="With --wait, cancel queries that have not finished after this many seconds",
+)
+@click.option(
+    "--upstream",
+    is_flag=True,
+    help="Also refresh the queries whose results the dashboard's queries read, "
+    "in dependency order. Implies --wait",
+)
+@click.option(
+    "--max-age",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Only re-execute queries whose latest result is older than this many seconds",
+)
+@click.option(
+    "--max-age-tag",
+    multiple=True,
+    metavar="TAG=SECONDS",
+    help="--max-age for queries with this tag. Can be repeated",
+)
+@click.option(
+    "--max-age-query",
+    multiple=True,
+    metavar="ID=SECONDS",
+    help="--max-age for one query. Can be repeated",
+)
+@click.option(
+    "--timezone",
+    help="Resolve dynamic dates in this timezone, e.g. Europe/Berlin. "
+    "Defaults to local time",
+)
+@click.option(
+    "--week-start",
+    type=click.IntRange(0, 6),
+    default=0,
+    show_default=True,
+    help="First day of the week for This Week and Last Week, 0 is Monday",
+)
+def main(
+    url,
+    key,
+    slug,
+    wait,
+    max_per_data_source,
+    timeout,
+    upstream,
+    max_age,
+    max_age_tag,
+    max_age_query,
+    timezone,
+    week_start,
+):
     """Refresh URL/dashboards/SLUG using KEY"""
 
-    refresh_dashboard(url, key, slug)
+    try:
+        dates = DynamicDates(timezone, week_start)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--timezone")
+
+    freshness = FreshnessPolicy(
+        max_age=max_age,
+        per_query={int(k): v for k, v in parse_ages(max_age_query).items()},
+        per_tag=parse_ages(max_age_tag),
+    )
+
+    failed = refresh_dashboard(
+        url,
+        key,
+        slug,
+        wait=wait,
+        max_per_data_source=max_per_data_source,
+        timeout=timeout,
+        upstream=upstream,
+        freshness=freshness,
+        dates=dates,
+    )
+
+    if failed:
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
@@ -1,48 +1,46 @@
-import os
-import requests
-import time
 from pprint import pprint
-import json
 
+from redash_toolbelt import Redash
 
-def poll_job(s, redash_url, job):
-    # TODO: add timeout
-    while job['status'] not in (3,4):
-        response = s.get('{}/api/jobs/{}'.format(redash_url, job['id']))
-        job = response.json()['job']
-        time.sleep(1)
 
-    if job['status'] == 3:
-        return job['query_result_id']
-    
-    return None
+def get_fresh_query_result(redash_url, query_id, api_key, params, timeout=None):
+    return list(iter_fresh_query_result(redash_url, query_id, api_key, params, timeout))
 
 
-def get_fresh_query_result(redash_url, query_id, api_key, params):
-    s = requests.Session()
-    s.headers.update({'Authorization': 'Key {}'.format(api_key)})
+def iter_fresh_query_result(redash_url, query_id, api_key, params, timeout=None):
+    """Like get_fresh_query_result, but yields the rows as they are downloaded.
 
-    payload = dict(max_age=0, parameters=params)
+    Raises QueryTimeoutError if the query is still running after `timeout`
+    seconds, and QueryExecutionError if it fails.
+    """
+    client = Redash(redash_url, api_key)
 
-    response = s.post('{}/api/queries/{}/results'.format(redash_url, query_id), data=json.dumps(payload))
+    # Pass max_age=0 to ensure a new result is provided.
+    job = client.execute_query(query_id, parameters=params, max_age=0)
 
-    if response.status_code != 200:
-        raise Exception('Refresh failed.')
+    yield from job.rows(timeout=timeout)
 
-    result_id = poll_job(s, redash_url, response.json()['job'])
 
-    if result_id:
-        response = s.get('{}/api/queries/{}/results/{}.json'.format(redash_url, query_id, result_id))
-        if response.status_code != 200:
-            raise Exception('Failed getting results.')
-    else:
-        raise Exception('Query execution failed.')
+def save_fresh_query_result(
+    redash_url, query_id, api_key, params, path, fmt="csv", timeout=None, progress=None
+):
+    """Like get_fresh_query_result, but writes the result to `path` as it is
+    downloaded instead of decoding it.
+
+    `fmt` is "csv", "json", "ndjson", or "parquet" or "arrow" for a columnar
+    file that pandas can load without parsing (these need pyarrow). `progress(bytes_downloaded, total_bytes)`
+    is called as the download advances. Returns the number of bytes written.
+    """
+    client = Redash(redash_url, api_key)
+
+    job = client.execute_query(query_id, parameters=params, max_age=0)
+
+    return job.download(path, fmt=fmt, progress=progress, timeout=timeout)
 
-    return response.json()['query_result']['data']['rows']
 
 if __name__ == '__main__':
     params = {'some_parameter': 1}
     query_id = 1234
     # Need to use a *user API key* here (and not a query API key).
     api_key = '...'
-    pprint(get_fresh_query_result('https://app.redash.io/acme', query_id, api_key, params))
\ No newline at end of file
+    pprint(get_fresh_query_result('https://app.redash.io/acme', query_id, api_key, params))
@@ -0,0 +1,102 @@
+import csv
+import json
+import sys
+
+import click
+from redash_toolbelt import Redash, ResultCache
+from redash_toolbelt.jobs import SUCCESS
+from redash_toolbelt.sweep import sweep
+
+
+def read_parameter_sets(path):
+    """Parameter dicts from a JSON list, a JSON-lines file or a CSV file
+    with one column per parameter."""
+
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            return list(csv.DictReader(f))
+        if path.endswith((".ndjson", ".jsonl")):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+@click.command()
+@click.argument("url")
+@click.argument("key")
+@click.argument("query_id", type=int)
+@click.argument("params_path", metavar="PARAMS", type=click.Path(exists=True))
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="How many executions may run at the same time",
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    type=click.Path(dir_okay=False),
+    help="Keep results in this SQLite file and only execute parameter sets "
+    "that are missing from it",
+)
+@click.option(
+    "--ttl",
+    type=float,
+    help="With --cache, re-execute parameter sets whose result is older than "
+    "this many seconds",
+)
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Write one JSON line per parameter set to this file instead of stdout",
+)
+@click.option(
+    "--timeout", type=float, help="Cancel runs that take longer than this many seconds"
+)
+def main(
+    url, key, query_id, params_path, concurrency, cache_path, ttl, output, timeout
+):
+    """Execute QUERY_ID once per parameter set in PARAMS.
+
+    PARAMS is a JSON list of parameter objects, a .ndjson/.jsonl file with
+    one object per line, or a .csv file with one column per parameter.
+    """
+
+    client = Redash(url, key, concurrency=concurrency)
+    cache = ResultCache(cache_path, ttl=ttl) if cache_path else None
+    parameter_sets = read_parameter_sets(params_path)
+
+    cached = failed = 0
+
+    for job in sweep(
+        client,
+        query_id,
+        parameter_sets,
+        max_in_flight=concurrency,
+        cache=cache,
+        timeout=timeout,
+    ):
+        record = {"parameters": job.parameters}
+
+        if job.status == SUCCESS:
+            record["rows"] = job.result()["data"]["rows"]
+        else:
+            record["error"] = job.job.get("error")
+            failed += 1
+
+        cached += job.id is None and job.query_result is not None
+        output.write(json.dumps(record) + "\n")
+
+    print(
+        f"{len(parameter_sets)} parameter sets: {cached} from cache, "
+        f"{failed} failed",
+        file=sys.stderr,
+    )
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
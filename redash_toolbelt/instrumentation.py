@@ -0,0 +1,154 @@
+import atexit
+import json
+import math
+import sys
+import threading
+from collections import namedtuple
+
+# Passed to the `before` and `after` hooks of a `Redash` client. `before` hooks
+# only get `method`, `path` and `template`; the other fields are None.
+RequestEvent = namedtuple(
+    "RequestEvent",
+    "method path template status elapsed request_bytes response_bytes retries cached",
+)
+
+# Latencies are counted in buckets that grow by 5%, so percentiles are
+# accurate to within 5% no matter how many requests are recorded.
+BUCKET_GROWTH = 1.05
+SMALLEST_BUCKET = 0.0001
+
+
+class LatencyCollector(object):
+    """Collects per-endpoint latency histograms from `after` hooks.
+
+    Attach it with `collector.attach(client)`, or pass it in
+    `hooks={"after": [collector]}` when creating clients. Endpoints are
+    grouped by method and path template, e.g. `GET api/queries/{id}`.
+    Responses served from a client's cache are skipped unless
+    `include_cached` is set.
+    """
+
+    def __init__(self, include_cached=False):
+        self.include_cached = include_cached
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def attach(self, client):
+        client.hooks["after"].append(self)
+        return self
+
+    def __call__(self, event):
+        if event.cached and not self.include_cached:
+            return
+
+        key = "{} {}".format(event.method, event.template)
+
+        with self._lock:
+            if key not in self._endpoints:
+                self._endpoints[key] = _Histogram()
+            self._endpoints[key].add(event)
+
+    def summary(self):
+        """Return {endpoint: stats} with the count, error count, retries,
+        bytes transferred and p50/p95/p99/max latency in seconds."""
+
+        with self._lock:
+            return {key: hist.stats() for key, hist in sorted(self._endpoints.items())}
+
+    def to_json(self, fp):
+        json.dump(self.summary(), fp, indent=4)
+
+    def print_summary(self, file=None):
+        file = file or sys.stdout
+        summary = self.summary()
+
+        if not summary:
+            print("No requests were recorded", file=file)
+            return
+
+        align = max(len(key) for key in summary)
+        columns = ["count", "errors", "retries", "p50", "p95", "p99", "max"]
+
+        print("", file=file)
+        print(
+            f"{'endpoint':<{align}} | " + " | ".join(f"{col:>8}" for col in columns),
+            file=file,
+        )
+        print("-" * align + " | " + " | ".join("-" * 8 for _ in columns), file=file)
+
+        for key, stats in sorted(
+            summary.items(), key=lambda item: item[1]["total"], reverse=True
+        ):
+            counts = [f"{stats[col]:>8}" for col in columns[:3]]
+            times = [f"{stats[col] * 1000:>6.0f}ms" for col in columns[3:]]
+            print(f"{key:<{align}} | " + " | ".join(counts + times), file=file)
+
+        print("", file=file)
+
+    def report_at_exit(self, json_path=None, show_summary=True):
+        """Print the summary and/or write it to `json_path` when Python exits."""
+
+        def report():
+            if show_summary:
+                self.print_summary()
+            if json_path:
+                with open(json_path, "w") as fp:
+                    self.to_json(fp)
+
+        atexit.register(report)
+
+
+class _Histogram(object):
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, event):
+        elapsed = event.elapsed or 0.0
+        bucket = _bucket(elapsed)
+
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.errors += event.status is None or event.status >= 400
+        self.retries += event.retries or 0
+        self.request_bytes += event.request_bytes or 0
+        self.response_bytes += event.response_bytes or 0
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def percentile(self, pct):
+        rank = math.ceil(self.count * pct / 100)
+        seen = 0
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max, SMALLEST_BUCKET * BUCKET_GROWTH ** (bucket + 1))
+
+        return self.max
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "total": self.total,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+def _bucket(elapsed):
+    if elapsed <= SMALLEST_BUCKET:
+        return 0
+    return int(math.log(elapsed / SMALLEST_BUCKET, BUCKET_GROWTH))
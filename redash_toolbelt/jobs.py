@@ -0,0 +1,339 @@
+import threading
+import time
+from collections import deque
+
+import requests
+
+# Values of `job.status` in api/jobs/<id> responses
+PENDING = 1
+STARTED = 2
+SUCCESS = 3
+FAILURE = 4
+CANCELLED = 5
+
+FINISHED = (SUCCESS, FAILURE, CANCELLED)
+
+
+class QueryExecutionError(Exception):
+    """The query job failed or was cancelled."""
+
+
+class QueryTimeoutError(Exception):
+    """The query job did not finish before the deadline."""
+
+
+class Backoff(object):
+    """Polling intervals that start short and grow for long-running jobs.
+
+    The first interval is `initial` seconds; each following one is `factor`
+    times longer, up to `maximum`.
+    """
+
+    def __init__(self, initial=0.05, factor=1.5, maximum=5.0):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.reset()
+
+    def reset(self):
+        self.current = self.initial
+
+    def next(self):
+        delay = self.current
+        self.current = min(self.maximum, self.current * self.factor)
+        return delay
+
+
+class QueryJob(object):
+    """Handle on a query execution started by `Redash.execute_query`.
+
+    If Redash answered from its cache the handle is already done. Otherwise
+    call `wait`, `result` or `rows`, which poll api/jobs/<id> with a
+    `Backoff` until the job finishes. `submitted_at`, `started_at` and
+    `finished_at` record when each state was first observed.
+    """
+
+    def __init__(self, client, query_id, job=None, query_result=None, parameters=None):
+        self.client = client
+        self.query_id = query_id
+        self.job = job or {}
+        self.query_result = query_result
+        self.parameters = parameters
+
+        # Free for callers, e.g. to remember why the query was executed
+        self.context = None
+
+        self.submitted_at = time.time()
+        self.started_at = self.finished_at = None
+        if query_result is not None:
+            self.started_at = self.finished_at = self.submitted_at
+
+        self._cancelled = threading.Event()
+
+    def __repr__(self):
+        return "<QueryJob query={} job={} status={}>".format(
+            self.query_id, self.job.get("id"), self.status
+        )
+
+    @property
+    def id(self):
+        return self.job.get("id")
+
+    @property
+    def status(self):
+        if self.query_result is not None:
+            return SUCCESS
+        return self.job.get("status")
+
+    @property
+    def done(self):
+        return self.status in FINISHED
+
+    @property
+    def query_result_id(self):
+        if self.query_result is not None:
+            return self.query_result["id"]
+        return self.job.get("query_result_id")
+
+    def poll(self):
+        """GET api/jobs/<id> once and return True if the job has finished."""
+
+        if self.done:
+            return True
+
+        self.job = self.client._get(f"api/jobs/{self.id}").json()["job"]
+
+        now = time.time()
+        if self.started_at is None and self.status != PENDING:
+            self.started_at = now
+        if self.done:
+            self.finished_at = now
+
+        return self.done
+
+    def wait(self, timeout=None, backoff=None, cancel_on_timeout=True):
+        """Poll until the job finishes and return its query result id.
+
+        Raises `QueryTimeoutError` after `timeout` seconds, cancelling the job
+        unless `cancel_on_timeout` is False, and `QueryExecutionError` if the
+        job failed or was cancelled.
+        """
+
+        backoff = backoff or Backoff()
+        deadline = None if timeout is None else time.time() + timeout
+
+        while not self.poll():
+            delay = backoff.next()
+
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    if cancel_on_timeout:
+                        self.cancel()
+                    raise QueryTimeoutError(
+                        "Query {} did not finish within {}s".format(
+                            self.query_id, timeout
+                        )
+                    )
+                delay = min(delay, remaining)
+
+            # Returns early if another thread calls cancel()
+            if self._cancelled.wait(delay):
+                raise QueryExecutionError(
+                    "Query {} was cancelled".format(self.query_id)
+                )
+
+        if self.status != SUCCESS:
+            raise QueryExecutionError(
+                "Query {} {}: {}".format(
+                    self.query_id,
+                    "was cancelled" if self.status == CANCELLED else "failed",
+                    self.job.get("error"),
+                )
+            )
+
+        return self.query_result_id
+
+    def cancel(self):
+        """DELETE api/jobs/<id> to stop the job if it has not finished."""
+
+        self._cancelled.set()
+        if not self.done and self.id:
+            self.client._delete(f"api/jobs/{self.id}")
+
+    def result(self, timeout=None):
+        """Wait for the job and return the full query result object."""
+
+        if self.query_result is None:
+            result_id = self.wait(timeout=timeout)
+            self.query_result = self.client._get(
+                f"api/query_results/{result_id}"
+            ).json()["query_result"]
+
+        return self.query_result
+
+    def rows(self, timeout=None):
+        """Wait for the job and return an iterator over the result rows.
+
+        Unless Redash answered from its cache this is a `QueryResultStream`,
+        which downloads the rows as they are consumed.
+        """
+
+        if self.query_result is not None:
+            return iter(self.query_result["data"]["rows"])
+
+        result_id = self.wait(timeout=timeout)
+        return self.client.stream_query_result(result_id, query_id=self.query_id)
+
+    def download(self, destination, fmt="csv", progress=None, timeout=None):
+        """Wait for the job and save its result with
+        `Redash.download_query_result`."""
+
+        if self.query_result is not None:
+            result_id = self.query_result["id"]
+        else:
+            result_id = self.wait(timeout=timeout)
+
+        return self.client.download_query_result(
+            result_id, destination, fmt, query_id=self.query_id, progress=progress
+        )
+
+
+class JobTracker(object):
+    """Executes many queries and polls all of their jobs from a single loop.
+
+    `submit` queues an execution; `as_completed` starts queued executions
+    while fewer than `max_in_flight` jobs (and fewer than `max_per_group`
+    jobs of the same group) are running, polls every running job once per
+    round and yields each `QueryJob` as soon as it finishes, successfully or
+    not. Call `job.wait()` or `job.result()` on a yielded job to get its
+    result or the error.
+
+    Rounds are spaced by one `Backoff` shared by all jobs, which is reset
+    whenever a job starts or finishes. Jobs still running `timeout` seconds
+    after they were submitted to Redash are cancelled.
+    """
+
+    def __init__(
+        self, client, max_in_flight=8, max_per_group=None, backoff=None, timeout=None
+    ):
+        # Nothing could ever start, and as_completed would spin forever
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        if max_per_group is not None and max_per_group < 1:
+            raise ValueError("max_per_group must be at least 1 or None")
+
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.max_per_group = max_per_group
+        self.backoff = backoff or Backoff()
+        self.timeout = timeout
+
+        self.queue = deque()
+        self.running = []
+
+        self._groups = {}
+        self._in_flight = {}
+
+    def __len__(self):
+        return len(self.queue) + len(self.running)
+
+    def submit(self, query_id, parameters=None, max_age=0, context=None, group=None):
+        """Queue an execution of `query_id`.
+
+        `context` is set on the yielded job. At most `max_per_group` jobs of
+        the same `group`, e.g. a data source id, run at the same time.
+        """
+
+        self.queue.append((query_id, parameters, max_age, context, group))
+
+    def as_completed(self):
+        """Yield finished `QueryJob`s until nothing is queued or running.
+
+        Jobs may be submitted while iterating.
+        """
+
+        while self.queue or self.running:
+            changed = self._start_queued()
+            finished = []
+
+            for job in self.running:
+                was_started = job.started_at is not None
+
+                if job.done or self._poll(job):
+                    finished.append(job)
+                elif job.started_at is not None and not was_started:
+                    changed = True
+
+            for job in finished:
+                self.running.remove(job)
+                self._in_flight[self._groups.pop(job)] -= 1
+                yield job
+
+            if finished or changed:
+                self.backoff.reset()
+            elif self.running:
+                time.sleep(self.backoff.next())
+
+    def cancel(self):
+        """Drop queued executions and cancel running jobs."""
+
+        self.queue.clear()
+        for job in self.running:
+            job.cancel()
+
+    def _start_queued(self):
+        started = False
+        waiting = deque()
+
+        while self.queue and len(self.running) < self.max_in_flight:
+            query_id, parameters, max_age, context, group = self.queue.popleft()
+
+            if (
+                self.max_per_group is not None
+                and group is not None
+                and self._in_flight.get(group, 0) >= self.max_per_group
+            ):
+                waiting.append((query_id, parameters, max_age, context, group))
+                continue
+
+            try:
+                job = self.client.execute_query(
+                    query_id, parameters=parameters, max_age=max_age
+                )
+            except requests.exceptions.RequestException as e:
+                job = QueryJob(
+                    self.client,
+                    query_id,
+                    job={"status": FAILURE, "error": str(e)},
+                    parameters=parameters,
+                )
+
+            job.context = context
+            self.running.append(job)
+            self._groups[job] = group
+            self._in_flight[group] = self._in_flight.get(group, 0) + 1
+            started = True
+
+        # Executions held back by their group keep their place in the queue
+        self.queue.extendleft(reversed(waiting))
+        return started
+
+    def _poll(self, job):
+        try:
+            if job.poll():
+                return True
+        except requests.exceptions.RequestException as e:
+            job.job = dict(job.job, status=FAILURE, error=str(e))
+            return True
+
+        if self.timeout is not None and time.time() - job.submitted_at > self.timeout:
+            job.cancel()
+            job.job = dict(
+                job.job,
+                status=CANCELLED,
+                error="timed out after {}s".format(self.timeout),
+            )
+            return True
+
+        return False
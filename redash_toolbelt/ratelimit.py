@@ -0,0 +1,135 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+
+PERIODS = {"second": 1, "hour": 60 * 60, "day": 24 * 60 * 60}
+
+
+class RateLimit(object):
+    """Client-side token bucket rate limiter.
+
+    One bucket is kept per configured period. A bucket holds up to `rate`
+    tokens and refills continuously at `rate` tokens per period. `acquire`
+    blocks until every bucket has a token and then takes one from each.
+
+    When `state_file` is set, the remaining tokens are written to it under
+    `name` (e.g. the Redash URL) and restored on the next run, so consecutive
+    CLI invocations share one budget. The file is updated at most once every
+    `save_interval` seconds and when the interpreter exits.
+    """
+
+    def __init__(
+        self,
+        per_second=None,
+        per_hour=None,
+        per_day=None,
+        state_file=None,
+        name="default",
+        save_interval=5,
+    ):
+        rates = {"second": per_second, "hour": per_hour, "day": per_day}
+
+        now = time.time()
+        self.buckets = {
+            period: _Bucket(rate, PERIODS[period], now)
+            for period, rate in rates.items()
+            if rate
+        }
+        self.state_file = state_file
+        self.name = name
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        self._last_save = now
+
+        if self.state_file:
+            self._load()
+            atexit.register(self.save)
+
+    def acquire(self):
+        """Block until a request may be sent."""
+
+        while True:
+            with self._lock:
+                now = time.time()
+                for bucket in self.buckets.values():
+                    bucket.refill(now)
+
+                wait = max([b.wait_time() for b in self.buckets.values()] or [0])
+                if wait <= 0:
+                    for bucket in self.buckets.values():
+                        bucket.tokens -= 1
+                    if self.state_file and now - self._last_save >= self.save_interval:
+                        self._save(now)
+                    return
+
+            time.sleep(wait)
+
+    def remaining(self):
+        """Tokens currently left in each bucket, keyed by period."""
+
+        with self._lock:
+            now = time.time()
+            for bucket in self.buckets.values():
+                bucket.refill(now)
+            return {period: b.tokens for period, b in self.buckets.items()}
+
+    def save(self):
+        if not self.state_file:
+            return
+
+        with self._lock:
+            self._save(time.time())
+
+    def _save(self, now):
+        state = self._read_state()
+        state[self.name] = {
+            period: {"tokens": b.tokens, "updated_at": b.updated_at}
+            for period, b in self.buckets.items()
+        }
+
+        tmp_file = "{}.tmp".format(self.state_file)
+        with open(tmp_file, "w") as fp:
+            json.dump(state, fp, indent=4)
+        os.replace(tmp_file, self.state_file)
+
+        self._last_save = now
+
+    def _load(self):
+        saved = self._read_state().get(self.name, {})
+        now = time.time()
+
+        for period, bucket in self.buckets.items():
+            if period not in saved:
+                continue
+            bucket.tokens = min(bucket.rate, saved[period]["tokens"])
+            bucket.updated_at = min(now, saved[period]["updated_at"])
+            bucket.refill(now)
+
+    def _read_state(self):
+        try:
+            with open(self.state_file, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+
+class _Bucket(object):
+    def __init__(self, rate, period, now):
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated_at = now
+
+    def refill(self, now):
+        elapsed = max(0, now - self.updated_at)
+        self.tokens = min(self.rate, self.tokens + elapsed * self.rate / self.period)
+        self.updated_at = now
+
+    def wait_time(self):
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.period / self.rate
@@ -0,0 +1,264 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .jobs import CANCELLED, SUCCESS, JobTracker, QueryJob
+
+logger = logging.getLogger(__name__)
+
+# How the query results data source refers to other queries, e.g.
+# `select * from query_12 join cached_query_34 using (id)`
+QUERY_REFERENCE = re.compile(r"\b(?:cached_)?query_(\d+)\b")
+
+# Comments and string literals. Quoted names are matched so that they are
+# kept as they are: `"query_12"` is a reference, `'query_12'` is not.
+COMMENT_OR_STRING = re.compile(
+    r"""("(?:[^"]|"")*")|'(?:[^']|'')*'|--[^\n]*|/\*.*?(?:\*/|$)""", re.S
+)
+
+
+class FreshnessPolicy(object):
+    """How old the latest result of a query may be before it is re-executed.
+
+    The limit in seconds comes from `per_query` ({query id: seconds}), else
+    the strictest of `per_tag` ({tag: seconds}) among the query's tags, else
+    `max_age`. 0 always re-executes.
+
+    The limit is passed to Redash as `max_age`, which returns the latest
+    result instead of running the query when it was retrieved recently
+    enough.
+    """
+
+    def __init__(self, max_age=0, per_query=None, per_tag=None):
+        self.max_age = max_age
+        self.per_query = per_query or {}
+        self.per_tag = per_tag or {}
+
+    def max_age_for(self, query):
+        if query["id"] in self.per_query:
+            max_age = self.per_query[query["id"]]
+        else:
+            tag_ages = [
+                self.per_tag[tag]
+                for tag in query.get("tags") or []
+                if tag in self.per_tag
+            ]
+            max_age = min(tag_ages) if tag_ages else self.max_age
+
+        return int(max_age)
+
+
+def results_data_sources(client):
+    """Return the ids of the query results data sources."""
+
+    return {ds["id"] for ds in client.get_data_sources() if ds["type"] == "results"}
+
+
+def query_dependencies(query, results_sources=()):
+    """Return the ids of the queries whose results `query` reads.
+
+    These are the queries behind its query-based dropdown parameters and,
+    if its data source is one of the query results data sources in
+    `results_sources`, the queries referenced in its text outside comments
+    and string literals. On other data sources `query_12` is just a table
+    name.
+    """
+
+    dependencies = set()
+
+    if query.get("data_source_id") in results_sources:
+        text = COMMENT_OR_STRING.sub(
+            lambda m: m.group(1) or " ", query.get("query") or ""
+        )
+        dependencies.update(int(i) for i in QUERY_REFERENCE.findall(text))
+
+    for param in query.get("options", {}).get("parameters", []):
+        if param.get("queryId"):
+            dependencies.add(int(param["queryId"]))
+
+    dependencies.discard(query.get("id"))
+    return dependencies
+
+
+def fetch_upstream(client, queries, concurrency=8, results_sources=None):
+    """Add every query that `queries` depend on, directly or not, to `queries`.
+
+    `queries` is a {query id: query} dict and is updated in place. Each round
+    fetches the missing queries of the previous one in parallel. References
+    to queries that no longer exist or that the API key cannot read are
+    logged and ignored. `results_sources` defaults to
+    `results_data_sources(client)`.
+    """
+
+    if results_sources is None:
+        results_sources = results_data_sources(client)
+
+    missing = _missing_upstream(queries, results_sources)
+    tried = set()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while missing:
+            tried.update(missing)
+            for query in executor.map(lambda i: _get_query(client, i), missing):
+                if query is not None:
+                    queries[query["id"]] = query
+
+            missing = _missing_upstream(queries, results_sources) - tried
+
+    return queries
+
+
+def topological_levels(upstream):
+    """Group the keys of `upstream`, a {query id: ids it depends on} dict,
+    into levels that only depend on earlier levels.
+
+    Dependencies that are not keys of `upstream` are ignored. Raises
+    `ValueError` if the queries reference each other in a cycle.
+    """
+
+    remaining = {i: set(deps) & set(upstream) for i, deps in upstream.items()}
+    levels = []
+
+    while remaining:
+        level = sorted(i for i, deps in remaining.items() if not deps)
+        if not level:
+            raise ValueError(
+                "Queries reference each other in a cycle: {}".format(sorted(remaining))
+            )
+
+        levels.append(level)
+        for i in level:
+            del remaining[i]
+        for deps in remaining.values():
+            deps.difference_update(level)
+
+    return levels
+
+
+def refresh_in_order(
+    client,
+    queries,
+    params_for=None,
+    max_in_flight=8,
+    max_per_data_source=None,
+    timeout=None,
+    freshness=None,
+    results_sources=None,
+):
+    """Refresh `queries` so that each one runs after the queries it reads.
+
+    `queries` is a {query id: query} dict. A query is submitted as soon as
+    all of its dependencies among `queries` have finished, so independent
+    queries run in parallel, subject to the `JobTracker` limits. The
+    parameters of each execution are `params_for(query)`, if given.
+    Dependencies are found with `query_dependencies`; `results_sources`
+    defaults to `results_data_sources(client)`.
+
+    With a `FreshnessPolicy`, queries whose latest result is recent enough
+    are answered from it instead of running, unless one of the queries they
+    read was re-executed. Such jobs have no `id`.
+
+    Yields each `QueryJob` as it finishes. When a query fails, the queries
+    depending on it are not run; they are yielded as cancelled jobs.
+    """
+
+    if results_sources is None:
+        results_sources = results_data_sources(client)
+
+    upstream = {
+        i: query_dependencies(q, results_sources) & set(queries)
+        for i, q in queries.items()
+    }
+
+    # Fail early on cycles, which would never finish
+    topological_levels(upstream)
+
+    downstream = {i: [] for i in queries}
+    for i, deps in upstream.items():
+        for dep in deps:
+            downstream[dep].append(i)
+
+    waiting_on = {i: len(deps) for i, deps in upstream.items()}
+    skipped = set()
+    stale = set()
+
+    tracker = JobTracker(
+        client,
+        max_in_flight=max_in_flight,
+        max_per_group=max_per_data_source,
+        timeout=timeout,
+    )
+
+    def submit(query_id):
+        query = queries[query_id]
+        use_cached = freshness is not None and query_id not in stale
+        tracker.submit(
+            query_id,
+            parameters=params_for(query) if params_for else None,
+            max_age=freshness.max_age_for(query) if use_cached else 0,
+            group=query.get("data_source_id"),
+        )
+
+    for query_id, count in waiting_on.items():
+        if not count:
+            submit(query_id)
+
+    for job in tracker.as_completed():
+        if job.status != SUCCESS:
+            yield job
+
+            for query_id in _descendants(downstream, job.query_id) - skipped:
+                skipped.add(query_id)
+                yield QueryJob(
+                    client,
+                    query_id,
+                    job={
+                        "status": CANCELLED,
+                        "error": "depends on query {}, which did not finish".format(
+                            job.query_id
+                        ),
+                    },
+                )
+            continue
+
+        for query_id in downstream[job.query_id]:
+            if job.id is not None:
+                stale.add(query_id)
+
+            waiting_on[query_id] -= 1
+            if not waiting_on[query_id] and query_id not in skipped:
+                submit(query_id)
+
+        yield job
+
+
+def _missing_upstream(queries, results_sources):
+    missing = set()
+    for query in queries.values():
+        missing.update(query_dependencies(query, results_sources))
+    return missing - set(queries)
+
+
+def _get_query(client, query_id):
+    try:
+        return client.get_query(query_id)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code in (403, 404):
+            logger.warning("Skipping upstream query %s: %s", query_id, e)
+            return None
+        raise
+
+
+def _descendants(downstream, query_id):
+    found = set()
+    stack = list(downstream[query_id])
+
+    while stack:
+        i = stack.pop()
+        if i not in found:
+            found.add(i)
+            stack.extend(downstream[i])
+
+    return found
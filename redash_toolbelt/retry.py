@@ -0,0 +1,78 @@
+import random
+import time
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class RetryPolicy(object):
+    """Decides whether a failed request to Redash is retried, and how long to wait.
+
+    Only `methods` are retried; POST is left out by default because repeating
+    it can create duplicate objects. Pass e.g. `methods={"GET", "POST"}` to opt
+    in. The wait before retry number `n` is `backoff_factor * 2 ** n` seconds,
+    capped at `max_backoff` and randomised with full jitter, unless the
+    response carries a `Retry-After` header, which is honoured as-is.
+    """
+
+    def __init__(
+        self,
+        total=3,
+        backoff_factor=0.5,
+        max_backoff=60,
+        statuses=RETRY_STATUSES,
+        methods=IDEMPOTENT_METHODS,
+        respect_retry_after=True,
+    ):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(m.upper() for m in methods)
+        self.respect_retry_after = respect_retry_after
+
+    def should_retry(self, method, attempt, status=None):
+        """`status` is None when the request failed with a connection error or timeout."""
+
+        if attempt >= self.total or method.upper() not in self.methods:
+            return False
+
+        return status is None or status in self.statuses
+
+    def backoff(self, attempt, response=None):
+        """Seconds to sleep before retry number `attempt` (counting from 0)."""
+
+        if response is not None and self.respect_retry_after:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return retry_after
+
+        delay = min(self.max_backoff, self.backoff_factor * 2**attempt)
+        return random.uniform(0, delay)
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds of a Retry-After header, or None."""
+
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at is None:
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    return max(0.0, retry_at.timestamp() - time.time())
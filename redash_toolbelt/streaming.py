@@ -0,0 +1,262 @@
+import codecs
+import json
+import re
+
+# One JSON token, or None at the end of the buffer. Strings are matched as a
+# whole so that brackets and quotes inside them are never mistaken for
+# structure; numbers and literals are matched only to be skipped.
+TOKEN = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")|([{}\[\]:,])|([^\s"{}\[\]:,]+))')
+WHITESPACE = re.compile(r"\s*")
+NUMBER_TAIL = re.compile(r"[\d.eE+-]*")
+
+CHUNK_SIZE = 64 * 1024
+
+
+class QueryResultStream(object):
+    """Iterate over the rows of a query result without loading the whole body.
+
+    `response` is a `requests.Response` opened with `stream=True` for
+    `api/query_results/<id>` or `api/queries/<id>/results/<id>.json`. Rows are
+    decoded one at a time as the body arrives, so memory use depends on the
+    size of a row rather than the size of the result.
+
+    `columns`, and the other small fields listed in `capture`, are filled in
+    as they are encountered. Redash sends `columns` before `rows`, so it is
+    normally available before the first row is yielded.
+
+    `bytes_read` counts the body downloaded so far, out of `total_bytes`
+    when the server sent its length.
+    """
+
+    def __init__(self, response, capture=("columns", "retrieved_at", "runtime")):
+        self.response = response
+        self.fields = {}
+        self.bytes_read = 0
+        self._rows = iter_json_array(
+            self._count(response.iter_content(chunk_size=CHUNK_SIZE)),
+            "rows",
+            capture,
+            self.fields,
+        )
+
+    @property
+    def columns(self):
+        return self.fields.get("columns")
+
+    @property
+    def total_bytes(self):
+        return content_length(self.response)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._rows.close()
+        self.response.close()
+
+    def _count(self, chunks):
+        for chunk in chunks:
+            self.bytes_read += len(chunk)
+            yield chunk
+
+
+def copy_body(response, fp, progress=None):
+    """Write the body of a streamed response to the binary file `fp` in chunks.
+
+    `progress(bytes_written, total_bytes)` is called after each chunk.
+    Returns the number of bytes written.
+    """
+
+    total = content_length(response)
+    written = 0
+
+    with response:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            fp.write(chunk)
+            written += len(chunk)
+            if progress:
+                progress(written, total)
+
+    return written
+
+
+def write_ndjson(rows, fp, progress=None):
+    """Write the rows of a `QueryResultStream` to the binary file `fp` as
+    JSON lines.
+
+    `progress(bytes_downloaded, total_bytes)` is called whenever a new chunk
+    of the result has been decoded. Returns the number of bytes written.
+    """
+
+    written = 0
+    reported = 0
+
+    with rows:
+        for row in rows:
+            line = json.dumps(row).encode("utf-8") + b"\n"
+            fp.write(line)
+            written += len(line)
+
+            if progress and rows.bytes_read != reported:
+                reported = rows.bytes_read
+                progress(reported, rows.total_bytes)
+
+    return written
+
+
+def content_length(response):
+    """Size of the body of `response`, or None if unknown.
+
+    The Content-Length of a compressed body does not match what
+    `iter_content` yields, so it is ignored.
+    """
+
+    length = response.headers.get("Content-Length")
+    if length is None or response.headers.get("Content-Encoding"):
+        return None
+    return int(length)
+
+
+def iter_json_array(chunks, key, capture=(), fields=None):
+    """Yield the items of the first array stored under `key` in a JSON document.
+
+    `chunks` is an iterable of bytes, e.g. `response.iter_content()`. Objects
+    are searched at any depth. The values of keys listed in `capture` are
+    decoded whole and stored in the `fields` dict.
+    """
+
+    reader = _Reader(chunks)
+    decoder = json.JSONDecoder()
+    fields = fields if fields is not None else {}
+    pending_key = None
+    found = False
+
+    while True:
+        match = reader.match(TOKEN)
+        if match is None:
+            return
+
+        string, punctuation = match.group(1), match.group(2)
+
+        if punctuation == ":" and pending_key is not None:
+            name, pending_key = pending_key, None
+
+            if name == key and not found:
+                reader.match(WHITESPACE)
+                if reader.peek() == "[":
+                    found = True
+                    reader.pos += 1
+                    yield from _iter_array_items(reader, decoder)
+
+            elif name in capture and name not in fields:
+                reader.match(WHITESPACE)
+                fields[name] = reader.decode(decoder)
+
+            continue
+
+        pending_key = json.loads(string) if string is not None else None
+
+
+def _iter_array_items(reader, decoder):
+    while True:
+        reader.match(WHITESPACE)
+        if reader.peek() == "]":
+            reader.pos += 1
+            return
+
+        yield reader.decode(decoder)
+
+        reader.match(WHITESPACE)
+        separator = reader.peek()
+        reader.pos += 1
+
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Malformed JSON array at offset {}".format(reader.pos))
+
+
+class _Reader(object):
+    """A text buffer over a stream of byte chunks that refills on demand."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+
+        # Drop what has been consumed so the buffer stays around one chunk.
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                self.buf += text
+                return True
+
+        self.buf += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return True
+
+    def peek(self):
+        while self.pos >= len(self.buf) and self.fill():
+            pass
+        return self.buf[self.pos : self.pos + 1]
+
+    def match(self, pattern):
+        """Match `pattern` at the current position, reading more data when the
+        match runs into the end of the buffer."""
+
+        while True:
+            match = pattern.match(self.buf, self.pos)
+            complete = match is not None and match.end() < len(self.buf)
+
+            if complete or self.eof:
+                if match is not None and match.group(0):
+                    self.pos = match.end()
+                    return match
+                return match if pattern is WHITESPACE else None
+
+            if not self.fill():
+                return None
+
+    def decode(self, decoder):
+        """Decode one JSON value at the current position."""
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+
+            # A number that runs up to the end of the buffer may continue in
+            # the next chunk.
+            is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if (
+                is_number
+                and not self.eof
+                and NUMBER_TAIL.match(self.buf, end).end() == len(self.buf)
+            ):
+                self.fill()
+                continue
+
+            self.pos = end
+            return value
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from .jobs import FAILURE, SUCCESS, JobTracker, QueryJob
+
+# The parts of a query result that sweeps keep and cache
+RESULT_FIELDS = ("id", "data", "retrieved_at", "runtime")
+
+
+def sweep(
+    client,
+    query_id,
+    parameter_sets,
+    max_in_flight=4,
+    cache=None,
+    max_age=0,
+    timeout=None,
+):
+    """Execute `query_id` once for each dict of parameters in `parameter_sets`.
+
+    At most `max_in_flight` executions run at the same time. Yields a
+    `QueryJob` per parameter set as it finishes, with the parameters in
+    `job.parameters`; `job.result()` returns the query result or raises if
+    the execution failed. Results are downloaded on up to `max_in_flight`
+    threads while the remaining jobs are polled, and only keep the
+    `RESULT_FIELDS` of the query result.
+
+    With a `ResultCache`, parameter sets that already have a fresh result
+    for the current query text are answered from it without contacting
+    Redash (those jobs have no `id`), and new results are added to it.
+    """
+
+    query_text = client.get_query(query_id)["query"]
+    tracker = JobTracker(client, max_in_flight=max_in_flight, timeout=timeout)
+
+    for parameters in parameter_sets:
+        cached = cache and cache.get(query_id, query_text, parameters)
+
+        if cached:
+            yield QueryJob(client, query_id, query_result=cached, parameters=parameters)
+        else:
+            tracker.submit(query_id, parameters=parameters, max_age=max_age)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        downloads = set()
+
+        for job in tracker.as_completed():
+            if job.status == SUCCESS:
+                downloads.add(executor.submit(_load, job, query_text, cache))
+            else:
+                yield job
+
+            done = {future for future in downloads if future.done()}
+            downloads -= done
+            for future in done:
+                yield future.result()
+
+        for future in as_completed(downloads):
+            yield future.result()
+
+
+def _load(job, query_text, cache):
+    try:
+        result = job.result()
+    except requests.exceptions.RequestException as e:
+        job.job = dict(job.job, status=FAILURE, error=str(e))
+        return job
+
+    job.query_result = {key: result[key] for key in RESULT_FIELDS if key in result}
+
+    if cache is not None:
+        cache.set(job.query_id, query_text, job.parameters, job.query_result)
+
+    return job
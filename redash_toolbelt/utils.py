@@ -0,0 +1,23 @@
+import re
+
+ID_SEGMENT = re.compile(r"^(\d+|[0-9a-f]{8}-?[0-9a-f-]{8,})(\.\w+)?$", re.IGNORECASE)
+
+
+def split_path(path):
+    """Return the segments of an API path, ignoring any query string."""
+
+    return path.split("?", 1)[0].strip("/").split("/")
+
+
+def is_id_segment(segment):
+    return ID_SEGMENT.match(segment) is not None
+
+
+def path_template(path):
+    """Replace object ids in an API path with `{id}`.
+
+    `api/queries/12/results/34.csv` becomes `api/queries/{id}/results/{id}.csv`
+    and `api/jobs/<uuid>` becomes `api/jobs/{id}`.
+    """
+
+    return "/".join(ID_SEGMENT.sub(r"{id}\2", segment) for segment in split_path(path))
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from redash_toolbelt import AsyncRedash
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    """Just enough of the Redash API for the tests below."""
+
+    queries = [
+        {"id": i, "schedule": {"interval": 60} if i % 3 == 0 else None}
+        for i in range(1, 31)
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.strip("/").partition("?")
+        params = dict(p.split("=") for p in query.split("&") if p)
+
+        if path == "api/queries":
+            page, page_size = int(params["page"]), int(params["page_size"])
+            start = (page - 1) * page_size
+            self._send(
+                {
+                    "count": len(self.queries),
+                    "page": page,
+                    "page_size": page_size,
+                    "results": self.queries[start : start + page_size],
+                }
+            )
+        elif path.startswith("api/queries/"):
+            self._send(self.queries[int(path.split("/")[2]) - 1])
+        elif path.startswith("api/jobs/"):
+            self._send({"job": {"id": "j", "status": 3, "query_result_id": 7}})
+        elif path == "api/query_results/7":
+            rows = [{"a": i} for i in range(2500)]
+            self._send({"query_result": {"id": 7, "data": {"rows": rows}}})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._send({"job": {"id": "j", "status": 1}})
+
+    def _send(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _with_stand_in(test):
+    server = HTTPServer(("127.0.0.1", 0), _StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_port)
+
+    # Threads that sent requests
+    threads = set()
+    hooks = {"before": [lambda event: threads.add(threading.get_ident())]}
+
+    async def run():
+        async with AsyncRedash(url, "key", concurrency=4, hooks=hooks) as client:
+            await test(client, threads)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_async_methods():
+    async def test(client, threads):
+        queries, query = await asyncio.gather(
+            client.paginate(client.queries, page_size=7), client.get_query(5)
+        )
+        assert [q["id"] for q in queries] == list(range(1, 31))
+        assert query["id"] == 5
+
+    _with_stand_in(test)
+
+
+def test_lazy_results_are_loaded_off_the_loop():
+    async def test(client, threads):
+        loop_thread = threading.get_ident()
+
+        scheduled = await client.scheduled_queries()
+        assert [q["id"] for q in scheduled] == list(range(3, 31, 3))
+
+        rows = [row async for row in client.stream_query_result(7)]
+        assert len(rows) == 2500
+
+        job = await client.execute_query(1)
+        assert job.query_result["id"] == 7
+
+        assert threads and loop_thread not in threads
+
+    _with_stand_in(test)
@@ -0,0 +1,103 @@
+import pytest
+
+from redash_toolbelt.jobs import CANCELLED, FAILURE, SUCCESS, QueryJob
+from redash_toolbelt.refresh import (
+    FreshnessPolicy,
+    query_dependencies,
+    refresh_in_order,
+    topological_levels,
+)
+
+RESULTS = 1
+POSTGRES = 2
+
+
+class FakeClient(object):
+    """Finishes every execution at once, failing the queries in `failing`."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.executed = []
+
+    def execute_query(self, query_id, parameters=None, max_age=0):
+        self.executed.append((query_id, max_age))
+        status = FAILURE if query_id in self.failing else SUCCESS
+        job = {"id": "job-{}".format(query_id), "status": status, "error": "boom"}
+        return QueryJob(self, query_id, job=job, parameters=parameters)
+
+
+def query(query_id, text="select 1", data_source_id=RESULTS):
+    return {"id": query_id, "query": text, "data_source_id": data_source_id}
+
+
+def refresh(client, queries, **kwargs):
+    jobs = refresh_in_order(client, queries, results_sources={RESULTS}, **kwargs)
+    return {job.query_id: job.status for job in jobs}
+
+
+def test_cycle_raises():
+    queries = {
+        1: query(1, "select * from query_3"),
+        2: query(2, "select * from query_1"),
+        3: query(3, "select * from query_2"),
+    }
+
+    with pytest.raises(ValueError):
+        topological_levels({1: {3}, 2: {1}, 3: {2}})
+
+    with pytest.raises(ValueError):
+        refresh(FakeClient(), queries)
+
+
+def test_upstream_runs_first():
+    queries = {
+        3: query(3, "select * from query_2 join query_1"),
+        2: query(2, "select * from query_1"),
+        1: query(1),
+    }
+    client = FakeClient()
+
+    assert refresh(client, queries) == {1: SUCCESS, 2: SUCCESS, 3: SUCCESS}
+    assert [i for i, _ in client.executed] == [1, 2, 3]
+
+
+def test_failed_upstream_skips_dependents():
+    queries = {
+        1: query(1),
+        2: query(2, "select * from query_1"),
+        3: query(3, "select * from cached_query_2"),
+        4: query(4),
+    }
+    client = FakeClient(failing={1})
+
+    statuses = refresh(client, queries)
+
+    assert statuses == {1: FAILURE, 2: CANCELLED, 3: CANCELLED, 4: SUCCESS}
+    assert sorted(i for i, _ in client.executed) == [1, 4]
+
+
+def test_dependents_of_executed_queries_are_stale():
+    queries = {1: query(1), 2: query(2, "select * from query_1")}
+    client = FakeClient()
+
+    refresh(client, queries, freshness=FreshnessPolicy(max_age=600))
+
+    # 1 may be answered from cache, 2 must see the new result of 1
+    assert client.executed == [(1, 600), (2, 0)]
+
+
+def test_references_in_comments_and_strings_are_ignored():
+    text = """
+    -- copied from query_10
+    select * from query_12 /* not query_13 */
+    where note = 'see query_14' and "query_15".id = 1
+    """
+
+    assert query_dependencies(query(1, text), {RESULTS}) == {12, 15}
+
+
+def test_references_on_other_data_sources_are_ignored():
+    q = query(1, "select * from analytics.query_11", data_source_id=POSTGRES)
+    q["options"] = {"parameters": [{"name": "p", "queryId": 20}]}
+
+    assert query_dependencies(q, {RESULTS}) == {20}
@@ -0,0 +1,66 @@
+import json
+
+from redash_toolbelt.streaming import QueryResultStream, iter_json_array
+
+
+class _StandInResponse(object):
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.headers = {"Content-Length": str(len(body))}
+
+    def iter_content(self, chunk_size=None):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i : i + self.chunk_size]
+
+    def close(self):
+        pass
+
+
+TEST_ROWS = [
+    {"a": 'say "hi" \\ \\"', "b": "café 中 \U0001f600", "n": 1234.5678e-2},
+    {"a": '"]}, {"rows": [', "b": "\n\t\u0000", "n": -9876543210, "t": True},
+    {"a": None, "b": {"rows": [1, 2]}, "n": 0, "t": False},
+]
+
+
+def _body(rows, ensure_ascii=True):
+    columns = [{"name": "a", "type": "string"}, {"name": "n", "type": "float"}]
+    document = {
+        "query_result": {
+            "id": 1,
+            "data": {"columns": columns, "rows": rows},
+            "runtime": 1.5,
+        }
+    }
+    return json.dumps(document, ensure_ascii=ensure_ascii).encode("utf-8")
+
+
+def test_rows_split_across_chunks():
+    # \u escapes with ensure_ascii, multibyte UTF-8 split between chunks without
+    for ensure_ascii in (True, False):
+        body = _body(TEST_ROWS, ensure_ascii)
+
+        for chunk_size in (1, 64):
+            stream = QueryResultStream(_StandInResponse(body, chunk_size))
+
+            assert list(stream) == TEST_ROWS
+            assert stream.columns[1]["name"] == "n"
+            assert stream.fields["runtime"] == 1.5
+            assert stream.bytes_read == stream.total_bytes == len(body)
+
+
+def test_numbers_split_across_chunks():
+    numbers = [12345, -6.25e10, 0.5, 7, 1e-7]
+    body = json.dumps({"values": numbers}).encode("utf-8")
+
+    for chunk_size in (1, 64):
+        chunks = _StandInResponse(body, chunk_size).iter_content()
+        assert list(iter_json_array(chunks, "values")) == numbers
+
+
+def test_empty_rows():
+    for body in (_body([]), b'{"data": {"rows" :\n[ ]}, "runtime": 2}'):
+        for chunk_size in (1, 64):
+            stream = QueryResultStream(_StandInResponse(body, chunk_size))
+            assert list(stream) == []